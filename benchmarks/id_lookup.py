@@ -0,0 +1,96 @@
+"""Times /api/0.6/nodes style id lookups.
+
+Loads a synthetic nodes table, then looks up lists of random ids (about half
+of them missing) the way the lookups used to, as an IN (...) literal, and
+through ids_where, which binds one array value or COPYs lists longer than
+bulk_id_copy_threshold. Prints the median time for each and the size of the
+statements and values sent (not counting COPY data), and exits non-zero if
+a 10000 id lookup through ids_where takes longer than max_seconds.
+
+Needs a scratch PostgreSQL database, given as a libpq connection string in
+XAPI_TEST_DSN. The xapi_bench schema it creates is dropped afterwards.
+
+    XAPI_TEST_DSN="dbname=scratch" python benchmarks/id_lookup.py [nodes] [max_seconds]
+"""
+
+import os
+import random
+import sys
+import time
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pyxapi'))
+import xapi
+
+list_sizes = [100, 1000, 10000, 50000]
+runs = 3
+
+def load(conn, nodes):
+    cursor = conn.cursor()
+    cursor.execute("""CREATE SCHEMA xapi_bench""")
+    cursor.execute("""CREATE TABLE xapi_bench.nodes AS
+            SELECT i::bigint AS id, 1 AS version, 1 AS user_id, '2012-01-01'::timestamp AS tstamp,
+                1::bigint AS changeset_id
+            FROM generate_series(1, %s) i""", (nodes,))
+    cursor.execute("""ALTER TABLE xapi_bench.nodes ADD PRIMARY KEY (id)""")
+    cursor.execute("""ANALYZE xapi_bench.nodes""")
+    conn.commit()
+
+def literal_where(cursor, ids):
+    """The id list as the lookups used to send it."""
+    return cursor.mogrify('id IN %s', (tuple(ids),))
+
+def lookup(conn, make_where, ids):
+    """Runs one lookup in its own transaction, returning (seconds, bytes sent, rows)."""
+    cursor = conn.cursor(cursor_factory=xapi.XapiCursor)
+    cursor.execute("""SET LOCAL search_path TO xapi_bench""")
+    del cursor.statements[:]
+
+    start = time.time()
+    xapi.query_nodes(cursor, make_where(cursor, ids))
+    cursor.execute("""SELECT count(*) FROM bbox_nodes""")
+    rows = cursor.fetchone()[0]
+    seconds = time.time() - start
+
+    sent = sum(len(sql) + len(repr(params or ())) for (sql, params) in cursor.statements)
+    conn.rollback()
+    return (seconds, sent, rows)
+
+def main():
+    dsn = os.environ.get('XAPI_TEST_DSN')
+    if not dsn:
+        sys.exit('Set XAPI_TEST_DSN to a scratch database.')
+
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    max_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+
+    xapi.query_engine = 'temp'
+    random.seed(0)
+
+    conn = psycopg2.connect(dsn, connection_factory=xapi.XapiConnection)
+    try:
+        load(conn, nodes)
+        print '%d nodes, bulk_id_copy_threshold %d' % (nodes, xapi.bulk_id_copy_threshold)
+
+        slowest = 0.0
+        for size in list_sizes:
+            ids = [random.randint(1, 2 * nodes) for i in range(size)]
+            for (name, make_where) in (('literal', literal_where), ('ids_where', xapi.ids_where)):
+                results = sorted(lookup(conn, make_where, ids) for i in range(runs))
+                (seconds, sent, rows) = results[runs // 2]
+                print '%6d ids %-10s %8.3fs %10d bytes sent %6d found' % (size, name, seconds, sent, rows)
+
+                if name == 'ids_where' and size == 10000:
+                    slowest = results[-1][0]
+    finally:
+        conn.rollback()
+        conn.cursor().execute("""DROP SCHEMA IF EXISTS xapi_bench CASCADE""")
+        conn.commit()
+        conn.close()
+
+    if slowest > max_seconds:
+        sys.exit('A 10000 id lookup took %.3fs, over the %.3fs limit.' % (slowest, max_seconds))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Measures what prefetching rows on a background thread gains.
+
+Serializes a synthetic extract of nodes to XML from a source that sleeps for
+fetch_ms every stream_itersize rows, standing in for the round trip of a
+server-side cursor fetch, first serially and then through prefetch(). Prints
+the median time of each and checks they produce the same output. Needs no
+database.
+
+    python benchmarks/prefetch.py [nodes] [fetch_ms]
+"""
+
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pyxapi'))
+import xapi
+
+runs = 3
+
+def synthetic_nodes(count):
+    r = random.Random(0)
+    nodes = []
+    for i in range(1, count + 1):
+        nodes.append({
+            'id': i,
+            'version': r.randint(1, 50),
+            'changeset_id': r.randint(1, 20000000),
+            'user_id': r.randint(1, 2000000),
+            'name': 'mapper%d' % r.randint(1, 1000),
+            'tstamp': datetime(2012, 1, 1),
+            'latitude': r.uniform(-90, 90),
+            'longitude': r.uniform(-180, 180),
+            'tags': dict(('key%d' % j, 'value%d' % r.randint(1, 100)) for j in range(r.choice([0, 0, 0, 2, 5]))),
+        })
+    return nodes
+
+def fetching(nodes, fetch_seconds):
+    """Yields nodes, pausing before each batch as a cursor fetch would."""
+    for (i, node) in enumerate(nodes):
+        if i % xapi.stream_itersize == 0:
+            time.sleep(fetch_seconds)
+        yield node
+
+def serialize(nodes, fetch_seconds, prefetch_enabled):
+    xapi.prefetch_enabled = prefetch_enabled
+    rows = xapi.prefetch(fetching(nodes, fetch_seconds))
+    try:
+        return ''.join(xapi.coalesce_chunks(xapi.write_node_xml(row) for row in rows))
+    finally:
+        rows.close()
+
+def measure(nodes, fetch_seconds, prefetch_enabled):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        output = serialize(nodes, fetch_seconds, prefetch_enabled)
+        times.append(time.time() - start)
+    return (sorted(times)[runs // 2], output)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    fetch_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 20.0
+
+    nodes = synthetic_nodes(count)
+    print '%d nodes, %gms per %d row fetch, median of %d runs' % (count, fetch_ms, xapi.stream_itersize, runs)
+
+    (serial_seconds, serial_output) = measure(nodes, fetch_ms / 1000, False)
+    (prefetch_seconds, prefetch_output) = measure(nodes, fetch_ms / 1000, True)
+    print 'serial     %6.2fs  %8.0f nodes/s' % (serial_seconds, count / serial_seconds)
+    print 'prefetched %6.2fs  %8.0f nodes/s' % (prefetch_seconds, count / prefetch_seconds)
+
+    if serial_output != prefetch_output:
+        sys.exit('Prefetching changed the output.')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Counts the round trips the relation section of a response takes.
+
+Streams a synthetic bbox_relations through the per-relation member query the
+serializers used to run, then through stream_relations, and prints the
+number of statements each sent and how long they took. Server-side cursors
+are turned off so every statement is exactly one round trip.
+
+Needs a scratch PostgreSQL database, given as a libpq connection string in
+XAPI_TEST_DSN. Everything is created in a transaction that is rolled back.
+
+    XAPI_TEST_DSN="dbname=scratch" python benchmarks/relation_members.py [relations] [members]
+"""
+
+import os
+import sys
+import time
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pyxapi'))
+import xapi
+
+_counting_factories = {}
+
+def counting_factory(factory):
+    """Subclasses a cursor class to count the statements it sends."""
+    if factory not in _counting_factories:
+        class CountingCursor(factory):
+            def execute(self, *args, **kwargs):
+                self.connection.statements += 1
+                return super(CountingCursor, self).execute(*args, **kwargs)
+
+            def copy_expert(self, *args, **kwargs):
+                self.connection.statements += 1
+                return super(CountingCursor, self).copy_expert(*args, **kwargs)
+
+        _counting_factories[factory] = CountingCursor
+    return _counting_factories[factory]
+
+class CountingConnection(xapi.XapiConnection):
+    statements = 0
+
+    def cursor(self, *args, **kwargs):
+        kwargs['cursor_factory'] = counting_factory(kwargs.get('cursor_factory') or psycopg2.extensions.cursor)
+        return super(CountingConnection, self).cursor(*args, **kwargs)
+
+def load(cursor, relations, members):
+    cursor.execute("""CREATE SCHEMA xapi_bench""")
+    cursor.execute("""SET LOCAL search_path TO xapi_bench""")
+    cursor.execute("""CREATE TABLE users (id int PRIMARY KEY, name text)""")
+    cursor.execute("""INSERT INTO users VALUES (1, 'bench')""")
+    cursor.execute("""CREATE TABLE relations AS
+            SELECT i::bigint AS id, 1 AS version, 1 AS user_id, '2012-01-01'::timestamp AS tstamp,
+                1::bigint AS changeset_id, ''::text AS tags
+            FROM generate_series(1, %s) i""", (relations,))
+    cursor.execute("""CREATE TABLE relation_members AS
+            SELECT r AS relation_id, (r * 100 + s)::bigint AS member_id, 'W'::character(1) AS member_type,
+                'outer'::text AS member_role, s AS sequence_id
+            FROM generate_series(1, %s) r, generate_series(1, %s) s""", (relations, members))
+    cursor.execute("""ALTER TABLE relation_members ADD PRIMARY KEY (relation_id, sequence_id)""")
+    cursor.execute("""CREATE TEMPORARY TABLE bbox_relations AS SELECT * FROM relations""")
+    cursor.execute("""ANALYZE""")
+
+def before(cursor):
+    """The relation section as the serializers used to stream it."""
+    cursor.execute('''SELECT bbox_relations.*, users.name FROM bbox_relations, users
+                      WHERE user_id = users.id ORDER BY id''')
+    relation_cursor = cursor.connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    members = 0
+    for row in cursor.fetchall():
+        relation_cursor.execute("""SELECT relation_id AS entity_id, member_id, member_type, member_role, sequence_id
+                                   FROM relation_members f
+                                   WHERE relation_id=%s
+                                   ORDER BY sequence_id""", (row['id'],))
+        members += len(relation_cursor.fetchall())
+    return members
+
+def after(cursor):
+    members = 0
+    with xapi.app.test_request_context('/api/0.6/map'):
+        xapi.g.rows_out = 0
+        for (row, relation_members) in xapi.stream_relations(cursor):
+            members += len(relation_members)
+    return members
+
+def measure(conn, name, f, cursor):
+    xapi.user_names = xapi.UserNameCache(xapi.user_name_cache_size)
+    conn.statements = 0
+    start = time.time()
+    members = f(cursor)
+    print '%-14s %8d statements %8.3fs (%d members)' % (name, conn.statements, time.time() - start, members)
+
+def main():
+    dsn = os.environ.get('XAPI_TEST_DSN')
+    if not dsn:
+        sys.exit('Set XAPI_TEST_DSN to a scratch database.')
+
+    relations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    members = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    xapi.query_engine = 'temp'
+    xapi.stream_server_side_cursors = False
+
+    conn = psycopg2.connect(dsn, connection_factory=CountingConnection)
+    cursor = conn.cursor(cursor_factory=xapi.XapiCursor)
+    try:
+        load(cursor, relations, members)
+        print '%d relations with %d members each' % (relations, members)
+
+        measure(conn, 'before', before, cursor)
+        for mode in ('cursor', 'copy'):
+            xapi.extraction_mode = mode
+            measure(conn, 'after (%s)' % mode, after, cursor)
+    finally:
+        conn.rollback()
+        conn.close()
+
+if __name__ == '__main__':
+    main()
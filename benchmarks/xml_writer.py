@@ -0,0 +1,133 @@
+"""Compares the XML writers with the lxml element building they replaced.
+
+Serializes synthetic nodes, ways and relations (with tags, roles and user
+names covering every escaped character and non-ASCII text) both ways, checks
+the output is byte-identical, and prints primitives per second for each.
+Needs lxml, but no database.
+
+    python benchmarks/xml_writer.py [primitives]
+"""
+
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from lxml import etree
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pyxapi'))
+import xapi
+
+def lxml_primitive_attributes(element, primitive):
+    element.set("id", str(primitive.get('id')))
+    element.set("version", str(primitive.get('version')))
+    element.set("changeset", str(primitive.get('changeset_id')))
+    element.set("user", unicode(primitive.get('name'), 'utf8'))
+    element.set("uid", str(primitive.get('user_id')))
+    element.set("visible", "true")
+    element.set("timestamp", primitive.get('tstamp').isoformat())
+
+def lxml_tags(parent_element, primitive):
+    for (k, v) in primitive.get('tags', {}).iteritems():
+        tag_elem = etree.Element('tag', {'k': unicode(k, 'utf8'), 'v': unicode(v, 'utf8')})
+        parent_element.append(tag_elem)
+
+def lxml_node(row):
+    elem = etree.Element('node', {
+        "lat": "%3.7f" % (row.get('latitude')),
+        "lon": "%3.7f" % (row.get('longitude'))
+    })
+    lxml_primitive_attributes(elem, row)
+    lxml_tags(elem, row)
+    return etree.tostring(elem, encoding='utf8') + '\n'
+
+def lxml_way(row):
+    elem = etree.Element('way')
+    lxml_primitive_attributes(elem, row)
+    lxml_tags(elem, row)
+    for nd in row.get('nodes', []):
+        elem.append(etree.Element('nd', ref=str(nd)))
+    return etree.tostring(elem, encoding='utf8') + '\n'
+
+def lxml_relation(row, members):
+    elem = etree.Element('relation')
+    lxml_primitive_attributes(elem, row)
+    lxml_tags(elem, row)
+    for member in members:
+        elem.append(etree.Element('member', {
+            'role': unicode(member.get('member_role'), 'utf8'),
+            'type': xapi.member_type_names.get(member['member_type'], member['member_type']),
+            'ref': str(member.get('member_id'))
+        }))
+    return etree.tostring(elem, encoding='utf8') + '\n'
+
+# Pieces text is built from: plain ASCII, everything that gets escaped, and
+# multi-byte UTF-8
+text_pieces = ['highway', 'name', 'Main St', '&', '<', '>', '"', "'", '\n', '\r', '\t', ' ',
+               u'Stra\xdfe'.encode('utf8'), u'\u6771\u4eac'.encode('utf8'), u'\U0001f6b2'.encode('utf8')]
+
+def text(r):
+    return ''.join(r.choice(text_pieces) for i in range(r.randint(0, 4)))
+
+def attributes(r, i):
+    return {
+        'id': i,
+        'version': r.randint(1, 50),
+        'changeset_id': r.randint(1, 20000000),
+        'user_id': r.randint(1, 2000000),
+        'name': text(r),
+        'tstamp': datetime(2012, 1, 1) + timedelta(seconds=r.randint(0, 180 * 86400)),
+        'tags': dict((text(r) or 'k', text(r)) for j in range(r.choice([0, 0, 1, 3, 8]))),
+    }
+
+def synthetic_rows(count):
+    r = random.Random(0)
+    nodes = []
+    ways = []
+    relations = []
+    for i in range(1, count + 1):
+        node = attributes(r, i)
+        node['latitude'] = r.uniform(-90, 90)
+        node['longitude'] = r.uniform(-180, 180)
+        nodes.append(node)
+
+        way = attributes(r, i)
+        way['nodes'] = [r.randint(1, 2 ** 40) for j in range(r.choice([0, 2, 5, 30]))]
+        ways.append(way)
+
+        members = [{'member_id': r.randint(1, 2 ** 40), 'member_type': r.choice('NWRNWRX'), 'member_role': text(r)}
+                   for j in range(r.choice([0, 1, 4, 20]))]
+        relations.append((attributes(r, i), members))
+    return (nodes, ways, relations)
+
+def measure(write, rows):
+    start = time.time()
+    output = [write(*row) for row in rows]
+    seconds = time.time() - start
+    return (output, len(rows) / seconds)
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    (nodes, ways, relations) = synthetic_rows(count)
+
+    mismatches = 0
+    for (name, rows, old, new) in (('nodes', [(n,) for n in nodes], lxml_node, xapi.write_node_xml),
+                                   ('ways', [(w,) for w in ways], lxml_way, xapi.write_way_xml),
+                                   ('relations', relations, lxml_relation, xapi.write_relation_xml)):
+        (old_output, old_rate) = measure(old, rows)
+        (new_output, new_rate) = measure(new, rows)
+        print '%-10s lxml %8.0f/s   templates %8.0f/s   %.1fx' % (name, old_rate, new_rate, new_rate / old_rate)
+
+        for (row, old_xml, new_xml) in zip(rows, old_output, new_output):
+            if old_xml != new_xml:
+                mismatches += 1
+                if mismatches <= 5:
+                    print 'Mismatch for %s %s:\n  lxml      %r\n  templates %r' % (name, row[0]['id'], old_xml, new_xml)
+
+    if mismatches:
+        sys.exit('%d primitives were written differently.' % mismatches)
+    print 'Output is byte-identical for all %d primitives.' % (3 * count)
+
+if __name__ == '__main__':
+    main()
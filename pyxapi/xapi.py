@@ -1,17 +1,222 @@
-from lxml import etree
-from flask import Flask, Response, request, g, stream_with_context, make_response, current_app
+from flask import Flask, Response, request, g, stream_with_context, make_response, current_app, has_request_context
 from functools import update_wrapper
+from werkzeug.wsgi import wrap_file
+from werkzeug.urls import url_encode
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
 import re
 import itertools
+import hashlib
+import tempfile
+from cStringIO import StringIO
 import json
+import base64
+try:
+    import ujson
+except ImportError:
+    ujson = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
 import os
+import errno
+import shutil
+import time
+import calendar
+import math
+import struct
+import zlib
+import threading
 import logging
+import collections
+import io
+import heapq
+import multiprocessing.pool
+import Queue
+import sys
 from datetime import timedelta, datetime
 
 osmosis_work_dir = '/home/yellowbkpk/.osmosis'
 
+db_params = dict(host='localhost', dbname='xapi', user='xapi', password='xapi')
+
+# Connections held open by each worker process. They're opened when a worker
+# starts (see warm_pool) rather than by its first request.
+db_pool_min_size = 2
+db_pool_max_size = 10
+
+# Seconds a request will wait for a free connection before being refused
+db_pool_timeout = 30
+
+# Single statement timeout set to 3 minutes
+db_statement_timeout = 180000
+
+# Largest bbox (in square degrees) the map call will serve, as advertised by capabilities
+max_bbox_area = 0.25
+
+# Large map requests can be split into a grid of parallel_map_grid x
+# parallel_map_grid tiles that are queried concurrently, each on its own pooled
+# connection, by a per-process pool of parallel_map_workers threads. Only bboxes
+# of at least parallel_map_min_area square degrees are split, and only when the
+# connection pool has the extra connections free.
+parallel_map_enabled = False
+parallel_map_grid = 2
+parallel_map_min_area = 0.01
+parallel_map_workers = 8
+
+# Requests are admitted by estimated cost (roughly, square degrees of data
+# scanned). Those above admission_heavy_cost are heavy. Each class has its own
+# limit on concurrent requests per process; requests over the limit wait in a
+# bounded queue that is served round-robin across clients.
+admission_heavy_cost = 0.01
+admission_limits = {'light': 8, 'heavy': 2}
+admission_queue_size = 32
+admission_queue_timeout = 30
+
+# Estimated cost of looking up a single primitive by id
+admission_id_cost = 0.000001
+
+# How much of the data each kind of predicate is assumed to let through
+admission_user_selectivity = 0.001
+admission_tag_selectivity = 0.05
+admission_any_tag_selectivity = 0.25
+
+# Predicate searches are costed by the planner (EXPLAIN) before they run.
+# Searches it expects to cost more than preflight_max_cost are refused, and
+# those above preflight_heavy_cost are moved into the heavy admission class.
+preflight_enabled = True
+preflight_max_cost = 10000000.0
+preflight_heavy_cost = 100000.0
+
+# Planner estimates are cached per query shape: the generated WHERE clause and
+# its values, except for the bbox (whose area is only kept to within a factor
+# of two) and the page position. An estimate is scaled by the ratio of the
+# bbox areas when it is reused, which assumes primitives are spread evenly
+# across a bbox; a crowded city and empty ocean of the same size share one.
+preflight_cache_size = 1000
+
+# Searches can be read in pages of at most search_max_page_size primitives by
+# passing limit=, then following the continuation token each page returns.
+# Tokens carry the replication timestamp they were issued under. By default
+# they stay valid across replications, so later pages may reflect newer data
+# (paging by id never repeats or skips a primitive that exists throughout).
+# With page_tokens_expire set, a token from before the latest replication is
+# refused so every page comes from the same data, but with minutely diffs
+# any search taking more than a minute to page through can never finish.
+search_max_page_size = 50000
+page_tokens_expire = False
+
+# Parsed predicates are cached by their text
+parse_cache_size = 1000
+
+# Queries with bound values are run through server-side prepared statements
+# (temp engine only). Each connection keeps at most this many.
+prepared_statement_limit = 200
+
+# Id lists longer than this are loaded into a temp table with COPY rather
+# than being sent as a single array value
+bulk_id_copy_threshold = 20000
+
+# How the bbox_* result sets are built for each request. 'temp' materializes
+# them as ON COMMIT DROP temp tables; 'cte' expresses them as common table
+# expressions in front of the streaming queries, so no DDL runs per request.
+# The cte engine runs each request in a REPEATABLE READ transaction, since its
+# pipeline is recomputed by every statement that reads it.
+query_engine = 'temp'
+
+# Stream results through named (server-side) cursors, fetching this many rows
+# per round trip, so a huge extract never has to fit in worker memory
+stream_server_side_cursors = True
+stream_itersize = 2000
+
+# How result sets are read for streaming: 'cursor' fetches rows through the
+# DB-API, 'copy' reads them with COPY ... TO STDOUT and parses the text format
+# directly, which avoids most of the per-row adapter overhead. COPY output is
+# spooled to a temp file once it grows past copy_spool_size bytes.
+extraction_mode = 'cursor'
+copy_spool_size = 8 * 1024 * 1024
+
+# Rows are fetched by a background thread while the previous ones are being
+# serialized, handed over in batches of prefetch_batch_size through a queue
+# holding at most prefetch_queue_size batches
+prefetch_enabled = True
+prefetch_batch_size = 500
+prefetch_queue_size = 4
+
+# Most user names kept in each process's user id to name cache. The cache is
+# emptied whenever the replication timestamp moves, so renames show up once
+# the diff carrying them has been applied.
+user_name_cache_size = 100000
+
+# Number of primitives encoded per json.dumps call
+json_batch_size = 500
+
+# Entities per PBF PrimitiveBlock (the format recommends at most 8000) and the
+# zlib level each block is compressed with
+pbf_block_size = 8000
+pbf_compression_level = 6
+
+# Streamed output is gathered into chunks of about this many bytes before being
+# handed to the server. The flush interval is only checked as the serializer
+# produces output, so a partial chunk is sent once it is that old and more
+# output arrives; while the serializer is stalled (waiting on the database),
+# what it has already produced waits with it.
+stream_chunk_size = 64 * 1024
+stream_flush_interval = 0.5
+
+# XML and JSON responses are compressed as they stream for clients that accept
+# it, at this level (zlib's 1-9 scale; zstd and brotli use their own). With
+# compression_sync_flush set, each chunk is flushed so clients can decode
+# the response as it arrives.
+compression_enabled = True
+compression_level = 6
+compression_sync_flush = True
+
+# Complete responses to map and predicate queries are cached in memory, spilling
+# to disk as they age out, until the replication timestamp moves forward. Each
+# process keeps its own cache, spilling to its own subdirectory of
+# response_cache_disk_dir, so both sizes are per process: with N workers the
+# cache can use N times as much memory and disk.
+response_cache_enabled = True
+response_cache_memory_size = 64 * 1024 * 1024
+response_cache_disk_dir = '/tmp/pyxapi-cache'
+response_cache_disk_size = 1024 * 1024 * 1024
+
+# Responses bigger than this are streamed without being cached
+response_cache_max_entry_size = 16 * 1024 * 1024
+
+# Identical requests (same query, format, encoding and replication timestamp)
+# that arrive while one is already running are coalesced: they are sent the
+# bytes the first request streams, read back from a spill file it writes as it
+# goes. Followers wait at most coalesce_wait_timeout seconds for the first
+# request to start streaming before running the query themselves. Requests are
+# only coalesced within a process: identical requests handled by different
+# workers each run their own query.
+coalesce_enabled = True
+coalesce_wait_timeout = 180
+
+# With spool_responses set, responses are written out to a temp file in
+# spool_dir (None for the system default) as fast as the database can produce
+# them. The connection, its transaction and the admission ticket are released
+# before the file is sent, using the server's wsgi.file_wrapper (sendfile)
+# where it has one, so slow clients don't hold a backend for the whole download.
+spool_responses = False
+spool_dir = None
+
+# Requests taking longer than this many seconds are logged with their phase
+# timings and the SQL they ran
+slow_request_time = 10.0
+
 app = Flask(__name__)
 
 file_handler = logging.FileHandler('xapi.log')
@@ -60,26 +265,1018 @@ def crossdomain(origin=None, methods=None, headers=None,
     return decorator
 
 
+class PoolTimeout(Exception):
+    pass
+
+class XapiConnection(psycopg2.extensions.connection):
+    """A connection that remembers which statements have been prepared on it
+    (a map of statement name to SQL)."""
+
+    def __init__(self, *args, **kwargs):
+        super(XapiConnection, self).__init__(*args, **kwargs)
+        self.prepared = {}
+
+class ConnectionPool(object):
+    """A thread-safe pool of database connections.
+
+    Connections are configured once when they are opened (hstore registration,
+    session settings) and are health checked each time they are checked out.
+    Returned connections are rolled back, which also drops any ON COMMIT DROP
+    temp tables left behind by the request."""
+
+    def __init__(self, min_size, max_size, timeout=None, **connect_kwargs):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.connect_kwargs = connect_kwargs
+
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+        # Pre-warm the pool so the first requests don't pay for connection setup
+        for i in range(min_size):
+            self._idle.append(self._connect())
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(connection_factory=XapiConnection, **self.connect_kwargs)
+        psycopg2.extras.register_hstore(conn)
+
+        cursor = conn.cursor()
+        cursor.execute('SET statement_timeout TO %s', (db_statement_timeout,))
+        cursor.close()
+
+        # SET is transactional, so commit it before anything can roll it back
+        conn.commit()
+        return conn
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+
+        return True
+
+    def _discard(self, conn):
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        """Checks out a connection, waiting at most timeout seconds (by
+        default, the pool's timeout) for one to become free."""
+        if timeout is None:
+            timeout = self.timeout
+
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+
+        while True:
+            conn = None
+            with self._cond:
+                while not self._idle and self._size >= self.max_size:
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolTimeout('No database connection available.')
+                        self._cond.wait(remaining)
+
+                if self._idle:
+                    conn = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn):
+                return conn
+
+            self._discard(conn)
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        if close or conn.closed:
+            self._discard(conn)
+            return
+
+        with self._cond:
+            self._idle.append(conn)
+            self._cond.notify()
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Pools inherited over a fork. They're kept referenced (and never closed) so
+# that garbage collection can't shut down sockets still used by the parent.
+_inherited_pools = []
+
+def get_pool():
+    """Returns this process's connection pool, creating it on first use."""
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            if _pool is not None:
+                _inherited_pools.append(_pool)
+
+            _pool = ConnectionPool(db_pool_min_size, db_pool_max_size, timeout=db_pool_timeout, **db_params)
+            _pool_pid = os.getpid()
+
+    return _pool
+
+def warm_pool():
+    """Opens this process's connection pool ahead of its first request.
+
+    Pools can't be shared across a fork, so this has to run in each worker
+    after it's forked: under uWSGI it's registered as a postfork hook below,
+    under gunicorn call it from a post_fork server hook."""
+    try:
+        get_pool()
+    except psycopg2.Error, e:
+        # The first request will try again
+        app.logger.warning("Couldn't open the connection pool: %s", e)
+
+if uwsgidecorators is not None:
+    uwsgidecorators.postfork(warm_pool)
+
+class XapiCursor(psycopg2.extras.DictCursor):
+    """A DictCursor that also carries the CTE definitions of the bbox_* result
+    sets built for a request (see query_engine), and remembers the statements
+    it has run for the slow request log."""
+
+    def __init__(self, *args, **kwargs):
+        super(XapiCursor, self).__init__(*args, **kwargs)
+        self.ctes = []
+        self.statements = []
+
+    def execute(self, query, vars=None):
+        self.statements.append((query, vars))
+        return super(XapiCursor, self).execute(query, vars)
+
+class Overloaded(Exception):
+    pass
+
+class _Ticket(object):
+    granted = False
+
+class AdmissionController(object):
+    """Limits how many requests of each cost class run at once.
+
+    Requests over a class's limit wait in a queue shared by all classes and
+    bounded at max_queue. Waiting requests are grouped by client and slots
+    are handed out round-robin between clients, so one client's burst can't
+    starve everyone else. Limits apply per process."""
+
+    def __init__(self, limits, max_queue, timeout):
+        self.limits = limits
+        self.max_queue = max_queue
+        self.timeout = timeout
+
+        self._active = dict((cost_class, 0) for cost_class in limits)
+        self._waiting = dict((cost_class, collections.OrderedDict()) for cost_class in limits)
+        self._queued = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, cost_class, client):
+        with self._cond:
+            waiting = self._waiting[cost_class]
+            if not waiting and self._active[cost_class] < self.limits[cost_class]:
+                self._active[cost_class] += 1
+                return
+
+            if self._queued >= self.max_queue:
+                raise Overloaded('Admission queue is full.')
+
+            ticket = _Ticket()
+            waiting.setdefault(client, collections.deque()).append(ticket)
+            self._queued += 1
+
+            deadline = time.time() + self.timeout
+            try:
+                while not ticket.granted:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Overloaded('Timed out waiting to be admitted.')
+                    self._cond.wait(remaining)
+            finally:
+                self._queued -= 1
+                if not ticket.granted:
+                    tickets = waiting[client]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del waiting[client]
+
+    def release(self, cost_class):
+        with self._cond:
+            self._active[cost_class] -= 1
+
+            waiting = self._waiting[cost_class]
+            while waiting and self._active[cost_class] < self.limits[cost_class]:
+                # Serve the client at the front of the rotation, then move it to the back
+                (client, tickets) = waiting.popitem(last=False)
+                tickets.popleft().granted = True
+                self._active[cost_class] += 1
+                if tickets:
+                    waiting[client] = tickets
+
+            self._cond.notify_all()
+
+admission = AdmissionController(admission_limits, admission_queue_size, admission_queue_timeout)
+
+def bbox_area(bbox):
+    (l, b, r, t) = bbox
+    return abs(r - l) * abs(t - b)
+
+def estimate_predicate_cost(predicate):
+    area = 360.0 * 180.0
+    selectivity = 1.0
+
+    for group in re.findall(r'(?:\[(.*?)\])', predicate):
+        (left, _, right) = group.partition('=')
+        if left == 'bbox':
+            try:
+                area = min(area, bbox_area(parse_bbox(right)))
+            except ValueError:
+                pass
+        elif left in ('@uid', '@changeset'):
+            selectivity *= admission_user_selectivity
+        else:
+            alternatives = 0.0
+            for value in right.split('|'):
+                if value == '*':
+                    alternatives += admission_any_tag_selectivity
+                else:
+                    alternatives += admission_tag_selectivity
+            selectivity *= min(1.0, alternatives * len(left.split('|')))
+
+    return area * selectivity
+
+def estimate_request_cost():
+    """Estimates the cost of the current request from its parameters alone,
+    before any queries are run."""
+    view_args = request.view_args or {}
+
+    if request.endpoint == 'map':
+        try:
+            return bbox_area(parse_bbox(request.args.get('bbox', '')))
+        except ValueError:
+            return 0.0
+
+    if request.endpoint in ('nodes', 'ways', 'relations'):
+        return len(view_args['ids'].split(',')) * admission_id_cost
+
+    if request.endpoint in ('nodes_as_queryarg', 'ways_as_queryarg', 'relations_as_queryarg'):
+        ids = request_id_list(request.endpoint.split('_')[0])
+        return len(id_separator.split(ids)) * admission_id_cost
+
+    if 'predicate' in view_args:
+        return estimate_predicate_cost(view_args['predicate'])
+
+    if request.endpoint == 'changes':
+        return estimate_predicate_cost(changes_predicate())
+
+    return 0.0
+
+class Histogram(object):
+    """A Prometheus histogram, kept per combination of label values."""
+
+    def __init__(self, name, description, labels, buckets):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+
+        with self._lock:
+            for (label_values, (counts, total, count)) in sorted(self._series.iteritems()):
+                labels = ''.join('%s="%s",' % pair for pair in zip(self.labels, label_values))
+                for (bound, n) in zip(self.buckets, counts):
+                    lines.append('%s_bucket{%sle="%r"} %d' % (self.name, labels, float(bound), n))
+                lines.append('%s_bucket{%sle="+Inf"} %d' % (self.name, labels, count))
+
+                labels = labels.rstrip(',')
+                lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+                lines.append('%s_count{%s} %d' % (self.name, labels, count))
+
+        return lines
+
+class Counter(object):
+    """A Prometheus counter."""
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return ['# HELP %s %s' % (self.name, self.description),
+                '# TYPE %s counter' % self.name,
+                '%s %d' % (self.name, self.value)]
+
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+request_duration = Histogram('xapi_request_duration_seconds', 'Time taken to serve requests, including streaming the response.',
+                             ('endpoint',), duration_buckets)
+phase_duration = Histogram('xapi_phase_duration_seconds', 'Time taken by each phase of a request.',
+                           ('endpoint', 'phase'), duration_buckets)
+response_bytes = Histogram('xapi_response_bytes', 'Size of OSM data responses as sent.',
+                           ('endpoint',), [4 ** i * 1024 for i in range(11)])
+response_rows = Histogram('xapi_response_rows', 'Number of primitives in OSM data responses.',
+                          ('endpoint',), [10 ** i for i in range(8)])
+coalesced_requests = Counter('xapi_coalesced_requests_total', 'Requests served by following an identical request already running.')
+
+def record_phase(name, seconds, rows=None):
+    g.timings.append((name, seconds, rows))
+
+def timed_phase(name, rows=False):
+    """Decorates a pipeline step taking a cursor to record how long it takes in
+    the request's timings. With rows set, the number of rows the step's last
+    statement produced (in its temp table) is recorded as well."""
+    def decorator(f):
+        def wrapped_function(cursor, *args, **kwargs):
+            # Steps run on worker threads (for map tiles) aren't timed individually
+            if not has_request_context():
+                return f(cursor, *args, **kwargs)
+
+            start = time.time()
+            result = f(cursor, *args, **kwargs)
+
+            count = None
+            if rows and query_engine != 'cte' and cursor.rowcount >= 0:
+                count = cursor.rowcount
+            record_phase(name, time.time() - start, count)
+            return result
+        return update_wrapper(wrapped_function, f)
+    return decorator
+
+def server_timing(timings):
+    entries = []
+    for (name, seconds, rows) in timings:
+        entry = '%s;dur=%.1f' % (name, seconds * 1000)
+        if rows is not None:
+            entry += ';desc="%d rows"' % rows
+        entries.append(entry)
+    return ', '.join(entries)
+
+def count_rows(rows):
+    """Passes rows through, adding how many there were to the request's count."""
+    n = 0
+    try:
+        for row in rows:
+            n += 1
+            yield row
+    finally:
+        g.rows_out += n
+        rows.close()
+
+def measure_stream(stream):
+    """Passes a response stream through, recording the bytes sent and the time
+    spent producing them."""
+    g.bytes_out = 0
+    elapsed = 0.0
+    try:
+        iterator = iter(stream)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                elapsed += time.time() - start
+
+            g.bytes_out += len(chunk)
+            yield chunk
+    finally:
+        record_phase('stream', elapsed, g.rows_out)
+        if hasattr(stream, 'close'):
+            stream.close()
+
+def log_slow_request(duration):
+    lines = ['Slow request %s from %s took %.2fs: %s' % (request.url, request.access_route[0], duration, server_timing(g.timings))]
+
+    cursor = getattr(g, 'cursor', None)
+    if cursor is not None:
+        if cursor.ctes:
+            lines.append(cte_prefix(cursor))
+
+        for (sql, params) in cursor.statements:
+            lines.append(sql if params is None else '%s -- %r' % (sql, params))
+
+            prepared = re.search(r'EXECUTE (xapi_\w+)', sql)
+            if prepared is not None and prepared.group(1) in cursor.connection.prepared:
+                lines.append('-- %s: %s' % (prepared.group(1), cursor.connection.prepared[prepared.group(1)]))
+
+    app.logger.warning('\n'.join(lines))
+
+def record_request_metrics():
+    endpoint = request.endpoint or 'unknown'
+    duration = time.time() - g.request_start
+
+    request_duration.observe(duration, endpoint)
+    for (phase, seconds, rows) in g.timings:
+        phase_duration.observe(seconds, endpoint, phase)
+
+    if g.bytes_out is not None:
+        response_bytes.observe(g.bytes_out, endpoint)
+    if g.bytes_out is not None and g.rows_out is not None:
+        response_rows.observe(g.rows_out, endpoint)
+
+    if duration > slow_request_time:
+        log_slow_request(duration)
+
+# Endpoints that are served without a database connection or admission ticket
+endpoints_without_database = set(['metrics'])
+
 @app.before_request
 def before_request():
-    # Check load average before allowing a request through
-    (one, five, fifteen) = os.getloadavg()
-    if five > 6.0:
-        app.logger.info("Rejecting %s from %s because load is %s.", request.url, request.access_route[0], five)
-        return Response("Server is overloaded right now. Try again later.", status=503)
+    g.request_start = time.time()
+    g.timings = []
+    g.rows_out = 0
+    g.bytes_out = None
+
+    # Answer conditional requests before taking a ticket or a connection
+    g.validators = request_validators()
+    if g.validators is not None and is_not_modified(g.validators):
+        return add_validators(Response(status=304), g.validators)
+
+    if request.endpoint in endpoints_without_database:
+        return
+
+    cost = estimate_request_cost()
+    if cost > admission_heavy_cost:
+        cost_class = 'heavy'
+    else:
+        cost_class = 'light'
 
-    g.db = psycopg2.connect(host='localhost', dbname='xapi', user='xapi', password='xapi')
-    psycopg2.extras.register_hstore(g.db)
-    g.cursor = g.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    return acquire_database(cost_class)
 
-    # Single statement timeout set to 3 minutes
-    g.cursor.execute('SET statement_timeout TO 180000;')
+def acquire_database(cost_class):
+    """Takes an admission ticket of cost_class and a connection for the
+    request, setting up g.cursor. Returns a response to send instead if
+    either isn't available."""
+    try:
+        admission.acquire(cost_class, request.access_route[0])
+    except Overloaded, e:
+        app.logger.info("Rejecting %s from %s (%s): %s", request.url, request.access_route[0], cost_class, e)
+        return Response("Server is overloaded right now. Try again later.", status=503, headers={'Retry-After': '30'})
 
-def json_default(o):
-    if type(o) is datetime:
-        return o.isoformat()
+    g.admission = cost_class
 
-def stream_osm_data_as_json(cursor, bbox=None, timestamp=None):
+    try:
+        g.db = get_pool().getconn()
+    except PoolTimeout, e:
+        app.logger.info("Rejecting %s from %s because no connection is available.", request.url, request.access_route[0])
+        return Response("Server is overloaded right now. Try again later.", status=503, headers={'Retry-After': '30'})
+
+    g.cursor = g.db.cursor(cursor_factory=XapiCursor)
+    begin_snapshot(g.cursor)
+
+def begin_snapshot(cursor):
+    """Makes every statement of the cursor's transaction see the same data
+    when the cte engine is in use. Must run before anything else does.
+
+    The cte engine recomputes the bbox_* pipeline in each streaming query, so
+    under READ COMMITTED a diff applied between them could leave the nodes,
+    ways and relations of one response disagreeing. The transaction can't be
+    READ ONLY as long id lists are still copied into a temp table."""
+    if query_engine == 'cte':
+        cursor.execute("""SET TRANSACTION ISOLATION LEVEL REPEATABLE READ""")
+
+@app.after_request
+def add_server_timing(response):
+    # Streamed responses only have the phases that ran before streaming began
+    if getattr(g, 'timings', None):
+        response.headers['Server-Timing'] = server_timing(g.timings)
+    return response
+
+@app.after_request
+def add_response_validators(response):
+    validators = getattr(g, 'validators', None)
+    if validators is not None and response.status_code == 200:
+        add_validators(response, validators)
+    return response
+
+@app.teardown_request
+def teardown_request(exception):
+    # Runs once the response (including an abandoned stream) is finished with
+    if hasattr(g, 'request_start'):
+        try:
+            record_request_metrics()
+        except Exception, e:
+            app.logger.exception(e)
+
+    # Let followers go if this request never streamed the response they wait on
+    flight = getattr(g, 'flight', None)
+    if flight is not None:
+        g.flight = None
+        flight.end('failed')
+
+    release_database()
+
+def release_database():
+    """Returns the request's connections to the pool and gives up its admission
+    ticket. Safe to call more than once."""
+    db = getattr(g, 'db', None)
+    if db is not None:
+        g.db = None
+        get_pool().putconn(db)
+
+    tile_connections = getattr(g, 'tile_connections', None)
+    if tile_connections:
+        g.tile_connections = None
+        for conn in tile_connections:
+            get_pool().putconn(conn)
+
+    cost_class = getattr(g, 'admission', None)
+    if cost_class is not None:
+        g.admission = None
+        admission.release(cost_class)
+
+def open_stream_cursor(connection, name):
+    """Opens a cursor to stream a result set through."""
+    if stream_server_side_cursors:
+        cursor = connection.cursor(name, cursor_factory=psycopg2.extras.DictCursor)
+        cursor.itersize = stream_itersize
+        return cursor
+
+    return connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+
+def stream_rows(cursor, name, sql):
+    """Streams the rows of a query against the bbox_* result sets built on cursor."""
+    stream_cursor = open_stream_cursor(cursor.connection, name)
+    try:
+        stream_cursor.execute(cte_prefix(cursor) + sql)
+        for row in stream_cursor:
+            yield row
+    finally:
+        stream_cursor.close()
+
+_copy_escape = re.compile(r'\\(?:([0-7]{1,3})|x([0-9a-fA-F]{1,2})|(.))')
+_copy_escapes = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def _copy_unescape_match(match):
+    (octal, hexadecimal, char) = match.groups()
+    if octal is not None:
+        return chr(int(octal, 8) & 0xff)
+    if hexadecimal is not None:
+        return chr(int(hexadecimal, 16))
+    return _copy_escapes.get(char, char)
+
+def copy_text(value):
+    """Decodes a field of COPY's text format."""
+    if '\\' not in value:
+        return value
+    return _copy_escape.sub(_copy_unescape_match, value)
+
+def copy_hstore(value):
+    return psycopg2.extras.HstoreAdapter.parse(copy_text(value), None)
+
+def copy_bytea(value):
+    # bytea in the (default) hex output format
+    return copy_text(value)[2:].decode('hex')
+
+def copy_bigint_array(value):
+    if value == '{}':
+        return []
+    return [int(v) for v in value[1:-1].split(',')]
+
+def copy_rows(cursor, sql, columns):
+    """Streams the rows of a query against the bbox_* result sets built on
+    cursor, read with COPY. columns is a list of (name, converter) pairs."""
+    spool = tempfile.SpooledTemporaryFile(max_size=copy_spool_size)
+    try:
+        cursor.copy_expert("""COPY (%s%s) TO STDOUT""" % (cte_prefix(cursor), sql), spool)
+        spool.seek(0)
+
+        for line in spool:
+            row = {}
+            for ((name, convert), value) in zip(columns, line[:-1].split('\t')):
+                if value == '\\N':
+                    row[name] = None
+                else:
+                    row[name] = convert(value)
+            yield row
+    finally:
+        spool.close()
+
+def query_rows(cursor, name, sql, columns):
+    """Streams the rows of sql using the configured extraction_mode.
+
+    sql has a %(tstamp)s placeholder for the timestamp column, which COPY
+    selects already formatted."""
+    if extraction_mode == 'copy':
+        return copy_rows(cursor, sql % {'tstamp': """to_char(tstamp, 'YYYY-MM-DD"T"HH24:MI:SS') AS tstamp"""}, columns)
+    return stream_rows(cursor, name, sql % {'tstamp': 'tstamp'})
+
+def isoformat(timestamp):
+    # Timestamps read with COPY arrive already formatted
+    if isinstance(timestamp, basestring):
+        return timestamp
+    return timestamp.isoformat()
+
+def iter_batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+class UserNameCache(object):
+    """A bounded, process-wide LRU map of user id to user name, dropped
+    whenever the replication timestamp moves forward."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.timestamp = None
+        self._names = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, connection, user_ids):
+        """Returns a dict of names for user_ids, fetching any that aren't cached
+        with a single query."""
+        timestamp = parse_timestamp(osmosis_work_dir)
+
+        names = {}
+        missing = []
+        with self._lock:
+            if timestamp > self.timestamp:
+                self._names.clear()
+                self.timestamp = timestamp
+
+            for user_id in set(user_ids):
+                if user_id in self._names:
+                    name = self._names.pop(user_id)
+                    self._names[user_id] = name
+                    names[user_id] = name
+                else:
+                    missing.append(user_id)
+
+        if missing:
+            cursor = connection.cursor()
+            try:
+                cursor.execute('SELECT id, name FROM users WHERE id = ANY(%s)', (missing,))
+                fetched = dict(cursor.fetchall())
+            finally:
+                cursor.close()
+
+            with self._lock:
+                for user_id in missing:
+                    # Primitives whose user row is missing get an empty name
+                    name = fetched.get(user_id, '')
+                    names[user_id] = name
+
+                    # Names read before a newer diff was seen may be stale
+                    if timestamp == self.timestamp:
+                        self._names[user_id] = name
+
+                while len(self._names) > self.max_size:
+                    self._names.popitem(last=False)
+
+        return names
+
+user_names = UserNameCache(user_name_cache_size)
+
+def with_user_names(cursor, rows):
+    """Fills in the name column of streamed rows from the user name cache."""
+    for batch in iter_batches(rows, stream_itersize):
+        names = user_names.lookup(cursor.connection, [row['user_id'] for row in batch])
+        for row in batch:
+            row['name'] = names[row['user_id']]
+            yield row
+
+_prefetch_done = object()
+
+def prefetch(rows):
+    """Iterates rows from a background thread, which fetches ahead (up to the
+    queue size) while the caller works on the rows it already has.
+
+    Everything that touches the database happens inside rows, on the
+    background thread. Closing the returned generator stops and joins that
+    thread, so the caller can then safely close the cursor."""
+    if not prefetch_enabled:
+        return rows
+    return _prefetch(rows)
+
+def _prefetch(rows):
+    batches = Queue.Queue(prefetch_queue_size)
+    stopping = threading.Event()
+    failure = []
+
+    def put(item):
+        while not stopping.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in iter_batches(rows, prefetch_batch_size):
+                if not put(batch):
+                    return
+        except:
+            failure.append(sys.exc_info())
+        finally:
+            rows.close()
+            put(_prefetch_done)
+
+    producer = threading.Thread(target=produce, name='xapi-prefetch')
+    producer.daemon = True
+    producer.start()
+
+    try:
+        while True:
+            batch = batches.get()
+            if batch is _prefetch_done:
+                break
+            for row in batch:
+                yield row
+
+        if failure:
+            (exc_type, exc_value, exc_traceback) = failure[0]
+            raise exc_type, exc_value, exc_traceback
+    finally:
+        stopping.set()
+        producer.join()
+
+class TileCursors(object):
+    """Stands in for the cursor of a map request that was split into tiles,
+    each with its own bbox_* result sets on its own connection. The stream_*
+    functions merge the tiles' id-ordered streams into one."""
+
+    def __init__(self, cursors):
+        self.cursors = cursors
+
+    def close(self):
+        for cursor in self.cursors:
+            cursor.close()
+
+def merge_by_id(streams, key):
+    """Merges id-ordered streams into one, dropping items whose id has already
+    been seen (primitives that cross tile edges are in more than one tile)."""
+    heap = []
+    try:
+        for (n, stream) in enumerate(streams):
+            item = next(stream, None)
+            if item is not None:
+                heap.append((key(item), n, item))
+        heapq.heapify(heap)
+
+        last_id = None
+        while heap:
+            (item_id, n, item) = heap[0]
+            following = next(streams[n], None)
+            if following is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (key(following), n, following))
+
+            if item_id != last_id:
+                last_id = item_id
+                yield item
+    finally:
+        for stream in streams:
+            stream.close()
+
+def row_id(row):
+    return row['id']
+
+def relation_row_id(pair):
+    return pair[0]['id']
+
+# The stream queries select a NULL name that with_user_names fills in, so they
+# don't have to join against users
+
+def stream_nodes(cursor):
+    if isinstance(cursor, TileCursors):
+        return count_rows(merge_by_id([_stream_nodes(c) for c in cursor.cursors], row_id))
+    return count_rows(_stream_nodes(cursor))
+
+def _stream_nodes(cursor):
+    return prefetch(with_user_names(cursor, query_rows(cursor, 'stream_nodes',
+                       '''SELECT id, version, changeset_id, ST_X(geom) as longitude, ST_Y(geom) as latitude, user_id, NULL::text AS name, %(tstamp)s, tags
+                          FROM bbox_nodes
+                          ORDER BY id''',
+                       [('id', int), ('version', int), ('changeset_id', int), ('longitude', float), ('latitude', float),
+                        ('user_id', int), ('name', copy_text), ('tstamp', copy_text), ('tags', copy_hstore)])))
+
+def stream_ways(cursor, inline_geometry=False):
+    """Streams the ways in bbox_ways. With inline_geometry, each also gets the
+    (lon, lat) coordinates of its nodes from its linestring, or None if they
+    can't be matched up with its node list."""
+    if isinstance(cursor, TileCursors):
+        return count_rows(merge_by_id([_stream_ways(c, inline_geometry) for c in cursor.cursors], row_id))
+    return count_rows(_stream_ways(cursor, inline_geometry))
+
+def _stream_ways(cursor, inline_geometry):
+    columns = [('id', int), ('version', int), ('user_id', int), ('tstamp', copy_text), ('changeset_id', int),
+               ('tags', copy_hstore), ('nodes', copy_bigint_array), ('name', copy_text)]
+    geometry = ''
+    if inline_geometry:
+        columns.append(('geometry', copy_bytea))
+        geometry = ', ST_AsBinary(linestring) AS geometry'
+
+    rows = with_user_names(cursor, query_rows(cursor, 'stream_ways',
+                       '''SELECT id, version, user_id, %(tstamp)s, changeset_id, tags, nodes, NULL::text AS name''' + geometry + '''
+                          FROM bbox_ways ORDER BY id''',
+                       columns))
+    if inline_geometry:
+        rows = with_way_coordinates(rows)
+    return prefetch(rows)
+
+def wkb_points(wkb):
+    """Returns the (x, y) points of a WKB LineString."""
+    wkb = str(wkb)
+    byte_order = '<' if wkb[0] == '\x01' else '>'
+    count = struct.unpack(byte_order + 'I', wkb[5:9])[0]
+    values = struct.unpack(byte_order + '%dd' % (2 * count), wkb[9:9 + 16 * count])
+    return zip(values[0::2], values[1::2])
+
+def with_way_coordinates(rows):
+    for row in rows:
+        # DictRows (from the cursor extraction mode) can't take new keys
+        row = dict(row)
+
+        coordinates = None
+        if row['geometry'] is not None:
+            coordinates = wkb_points(row['geometry'])
+            # Linestrings skip nodes that are missing from the database
+            if len(coordinates) != len(row['nodes'] or []):
+                coordinates = None
+        row['coordinates'] = coordinates
+        yield row
+
+def stream_relations(cursor):
+    """Streams (relation, members) pairs.
+
+    Members for every relation in bbox_relations are fetched with a single
+    query ordered by relation id and merged with the (also id-ordered)
+    relation stream, rather than querying relation_members once per relation."""
+    if isinstance(cursor, TileCursors):
+        return count_rows(merge_by_id([_stream_relations(c) for c in cursor.cursors], relation_row_id))
+    return count_rows(_stream_relations(cursor))
+
+def _stream_relations(cursor):
+    return prefetch(_merge_relation_members(cursor))
+
+def _merge_relation_members(cursor):
+
+    member_rows = query_rows(cursor, 'stream_relation_members',
+                              """SELECT relation_id AS entity_id, member_id, member_type, member_role, sequence_id
+                                 FROM relation_members
+                                 WHERE relation_id IN (SELECT id FROM bbox_relations)
+                                 ORDER BY relation_id, sequence_id""",
+                              [('entity_id', int), ('member_id', int), ('member_type', copy_text),
+                               ('member_role', copy_text), ('sequence_id', int)])
+
+    relation_rows = with_user_names(cursor, query_rows(cursor, 'stream_relations',
+                                '''SELECT id, version, user_id, %(tstamp)s, changeset_id, tags, NULL::text AS name
+                                   FROM bbox_relations ORDER BY id''',
+                                [('id', int), ('version', int), ('user_id', int), ('tstamp', copy_text),
+                                 ('changeset_id', int), ('tags', copy_hstore), ('name', copy_text)]))
+
+    try:
+        member = next(member_rows, None)
+        for row in relation_rows:
+            relation_id = row.get('id')
+
+            # Skip members of relations that aren't in the relation stream
+            while member is not None and member['entity_id'] < relation_id:
+                member = next(member_rows, None)
+
+            members = []
+            while member is not None and member['entity_id'] == relation_id:
+                members.append(member)
+                member = next(member_rows, None)
+
+            yield (row, members)
+    finally:
+        relation_rows.close()
+        member_rows.close()
+
+member_type_names = {'N': 'node', 'W': 'way', 'R': 'relation'}
+
+def json_dumps(o):
+    # ujson is considerably faster when it's available
+    if ujson is not None:
+        return ujson.dumps(o)
+    return json.dumps(o)
+
+def stream_json_array_items(objects):
+    """Streams the comma separated items of a JSON array, a batch at a time."""
+    for (n, batch) in enumerate(iter_batches(objects, json_batch_size)):
+        # Strip the brackets off of each encoded batch
+        items = json_dumps(batch)[1:-1]
+        if n:
+            yield ',' + items
+        else:
+            yield items
+
+def node_json(row):
+    return {
+        'id': row['id'],
+        'version': row['version'],
+        'changeset': row['changeset_id'],
+        'user': row['name'],
+        'uid': row['user_id'],
+        'visible': True,
+        'timestamp': isoformat(row['tstamp']),
+        'lat': row['latitude'],
+        'lon': row['longitude'],
+        'tags': row['tags']
+    }
+
+def way_json(row):
+    way = {
+        'id': row['id'],
+        'version': row['version'],
+        'changeset': row['changeset_id'],
+        'user': row['name'],
+        'uid': row['user_id'],
+        'visible': True,
+        'timestamp': isoformat(row['tstamp']),
+        'tags': row['tags'],
+        'nds': row['nodes']
+    }
+
+    coordinates = row.get('coordinates')
+    if coordinates is not None:
+        way['geometry'] = [{'lat': lat, 'lon': lon} for (lon, lat) in coordinates]
+
+    return way
+
+def relation_json(row, members):
+    return {
+        'id': row['id'],
+        'version': row['version'],
+        'changeset': row['changeset_id'],
+        'user': row['name'],
+        'uid': row['user_id'],
+        'visible': True,
+        'timestamp': isoformat(row['tstamp']),
+        'tags': row['tags'],
+        'members': [{
+            'role': member['member_role'],
+            'type': member_type_names.get(member['member_type'], member['member_type']),
+            'ref': member['member_id']
+        } for member in members]
+    }
+
+def stream_osm_data_as_json(cursor, bbox=None, timestamp=None, inline_geometry=False):
     """Streams OSM data from psql temp tables."""
 
     try:
@@ -97,122 +1294,89 @@ def stream_osm_data_as_json(cursor, bbox=None, timestamp=None):
         if bbox:
             yield '"bounds": {{"minlat": {1}, "minlon": {0}, "maxlat": {3}, "maxlon": {2}}},'.format(*bbox)
 
-        cursor.execute('''SELECT bbox_nodes.id, version, changeset_id, ST_X(geom) as longitude, ST_Y(geom) as latitude, user_id, name, tstamp, tags
-                        FROM bbox_nodes, users
-                        WHERE user_id = users.id
-                        ORDER BY id''')
-
-        rows = cursor.rowcount
-        n = 0
-
         yield '"nodes": ['
-        for row in cursor:
-            yield json.dumps({
-                'id': row['id'],
-                'version': row['version'],
-                'changeset': row['changeset_id'],
-                'user': row['name'],
-                'uid': row['user_id'],
-                'visible': True,
-                'timestamp': row['tstamp'],
-                'lat': row['latitude'],
-                'lon': row['longitude'],
-                'tags': row['tags']
-            }, default=json_default)
-            n += 1
-
-            if n != rows:
-                yield ','
-
-        cursor.execute('''SELECT bbox_ways.id, version, user_id, tstamp, changeset_id, tags, nodes, name
-                        FROM bbox_ways, users WHERE user_id = users.id ORDER BY id''')
-
-        rows = cursor.rowcount
-        n = 0
+        for chunk in stream_json_array_items(node_json(row) for row in stream_nodes(cursor)):
+            yield chunk
 
         yield '], "ways": ['
-        for row in cursor:
-            yield json.dumps({
-                'id': row['id'],
-                'version': row['version'],
-                'changeset': row['changeset_id'],
-                'user': row['name'],
-                'uid': row['user_id'],
-                'visible': True,
-                'timestamp': row['tstamp'],
-                'tags': row['tags'],
-                'nds': row['nodes']
-            }, default=json_default)
-            n += 1
-
-            if n != rows:
-                yield ','
-
-        cursor.execute('''SELECT bbox_relations.id, version, user_id, tstamp, changeset_id, tags, name
-                        FROM bbox_relations, users where user_id = users.id ORDER BY id''')
-
-        rows = cursor.rowcount
-        n = 0
+        for chunk in stream_json_array_items(way_json(row) for row in stream_ways(cursor, inline_geometry)):
+            yield chunk
 
         yield '], "relations": ['
-        relation_cursor = g.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        for row in cursor:
-
-            members = []
-            relation_cursor.execute("""SELECT relation_id AS entity_id, member_id, member_type, member_role, sequence_id
-                                       FROM relation_members f
-                                       WHERE relation_id=%s
-                                       ORDER BY sequence_id""", (row.get('id'),))
-
-            for member in relation_cursor:
-                member_type = member.get('member_type', None)
-                if member_type == 'N':
-                    member_type = 'node'
-                elif member_type == 'W':
-                    member_type = 'way'
-                elif member_type == 'R':
-                    member_type = 'relation'
-                members.append({
-                    'role': member['member_role'],
-                    'type': member_type,
-                    'ref': member['member_id']
-                })
-
-            yield json.dumps({
-                'id': row['id'],
-                'version': row['version'],
-                'changeset': row['changeset_id'],
-                'user': row['name'],
-                'uid': row['user_id'],
-                'visible': True,
-                'timestamp': row['tstamp'],
-                'tags': row['tags'],
-                'members': members
-            }, default=json_default)
-            n += 1
-
-            if n != rows:
-                yield ','
+        for chunk in stream_json_array_items(relation_json(row, members) for (row, members) in stream_relations(cursor)):
+            yield chunk
 
         yield ']}'
     finally:
         cursor.close()
 
-def write_primitive_attributes_xml(element, primitive):
-    element.set("id", str(primitive.get('id')))
-    element.set("version", str(primitive.get('version')))
-    element.set("changeset", str(primitive.get('changeset_id')))
-    element.set("user", unicode(primitive.get('name'), 'utf8'))
-    element.set("uid", str(primitive.get('user_id')))
-    element.set("visible", "true")
-    element.set("timestamp", primitive.get('tstamp').isoformat())
-
-def write_tags_xml(parent_element, primitive):
-    for (k, v) in primitive.get('tags', {}).iteritems():
-        tag_elem = etree.Element('tag', {'k': unicode(k, 'utf8'), 'v': unicode(v, 'utf8')})
-        parent_element.append(tag_elem)
-
-def stream_osm_data_as_xml(cursor, bbox=None, timestamp=None):
+# Escapes for attribute values, matching what libxml2 produces when serializing
+_xml_attribute_escapes = {
+    '&': '&amp;',
+    '<': '&lt;',
+    '>': '&gt;',
+    '"': '&quot;',
+    '\n': '&#10;',
+    '\r': '&#13;',
+    '\t': '&#9;',
+}
+_xml_attribute_special = re.compile(r'[&<>"\n\r\t]')
+
+def _xml_attribute_escape_match(match):
+    return _xml_attribute_escapes[match.group(0)]
+
+def xml_escape(value):
+    """Escapes a (UTF-8 encoded) string for use as an attribute value."""
+    if _xml_attribute_special.search(value) is None:
+        return value
+    return _xml_attribute_special.sub(_xml_attribute_escape_match, value)
+
+_xml_primitive_attributes = ' id="%s" version="%s" changeset="%s" user="%s" uid="%s" visible="true" timestamp="%s"'
+_xml_node_start = '<node lat="%3.7f" lon="%3.7f"'
+_xml_tag = '<tag k="%s" v="%s"/>'
+_xml_nd = '<nd ref="%s"/>'
+_xml_nd_location = '<nd ref="%s" lat="%3.7f" lon="%3.7f"/>'
+_xml_member = '<member ref="%s" role="%s" type="%s"/>'
+
+def write_primitive_attributes_xml(primitive):
+    return _xml_primitive_attributes % (
+        primitive['id'],
+        primitive['version'],
+        primitive['changeset_id'],
+        xml_escape(primitive['name']),
+        primitive['user_id'],
+        isoformat(primitive['tstamp']))
+
+def write_tags_xml(primitive):
+    return ''.join([_xml_tag % (xml_escape(k), xml_escape(v)) for (k, v) in primitive.get('tags', {}).iteritems()])
+
+def write_element_xml(name, start, children):
+    if children:
+        return '%s>%s</%s>\n' % (start, children, name)
+    return start + '/>\n'
+
+def write_node_xml(row):
+    start = (_xml_node_start % (row['latitude'], row['longitude'])) + write_primitive_attributes_xml(row)
+    return write_element_xml('node', start, write_tags_xml(row))
+
+def write_way_xml(row):
+    start = '<way' + write_primitive_attributes_xml(row)
+    coordinates = row.get('coordinates')
+    if coordinates is not None:
+        nds = ''.join([_xml_nd_location % (nd, lat, lon) for (nd, (lon, lat)) in zip(row['nodes'], coordinates)])
+    else:
+        nds = ''.join([_xml_nd % nd for nd in row.get('nodes', [])])
+    return write_element_xml('way', start, write_tags_xml(row) + nds)
+
+def write_relation_xml(row, members):
+    start = '<relation' + write_primitive_attributes_xml(row)
+    member_xml = ''.join([_xml_member % (member['member_id'],
+                                         xml_escape(member['member_role']),
+                                         member_type_names.get(member['member_type'], member['member_type']))
+                          for member in members])
+    return write_element_xml('relation', start, write_tags_xml(row) + member_xml)
+
+def stream_osm_data_as_xml(cursor, bbox=None, timestamp=None, inline_geometry=False):
     """Streams OSM data from psql temp tables."""
 
     try:
@@ -227,99 +1391,389 @@ def stream_osm_data_as_xml(cursor, bbox=None, timestamp=None):
         if bbox:
             yield '<bounds minlat="{1}" minlon="{0}" maxlat="{3}" maxlon="{2}"/>\n'.format(*bbox)
 
-        cursor.execute('''SELECT bbox_nodes.id, version, changeset_id, ST_X(geom) as longitude, ST_Y(geom) as latitude, user_id, name, tstamp, tags
-                        FROM bbox_nodes, users
-                        WHERE user_id = users.id
-                        ORDER BY id''')
+        for row in stream_nodes(cursor):
+            yield write_node_xml(row)
+
+        for row in stream_ways(cursor, inline_geometry):
+            yield write_way_xml(row)
+
+        for (row, members) in stream_relations(cursor):
+            yield write_relation_xml(row, members)
 
-        for row in cursor:
-            elem = etree.Element('node', {
-                "lat": "%3.7f" % (row.get('latitude')),
-                "lon": "%3.7f" % (row.get('longitude'))
-            })
-            write_primitive_attributes_xml(elem, row)
+        yield '</osm>\n'
+    finally:
+        cursor.close()
 
-            write_tags_xml(elem, row)
+def change_action_xml(action, row):
+    """Returns the tags that switch from the current osmChange action block to
+    the one row belongs in, and that action."""
+    row_action = 'create' if row['version'] == 1 else 'modify'
+    if row_action == action:
+        return ('', action)
 
-            yield etree.tostring(elem, encoding='utf8')
-            yield '\n'
+    switch = '<%s>\n' % row_action
+    if action is not None:
+        switch = '</%s>\n' % action + switch
+    return (switch, row_action)
 
-        cursor.execute('''SELECT bbox_ways.id, version, user_id, tstamp, changeset_id, tags, nodes, name
-                        FROM bbox_ways, users WHERE user_id = users.id ORDER BY id''')
+def stream_osm_change_as_xml(cursor, bbox=None, timestamp=None, inline_geometry=False):
+    """Streams OSM data from psql temp tables as an osmChange. Primitives at
+    their first version are creates and the rest are modifies."""
 
-        for row in cursor:
-            nds = row.get('nodes', [])
+    try:
+        yield '<?xml version="1.0" encoding="UTF-8"?>\n'
 
-            elem = etree.Element('way')
-            write_primitive_attributes_xml(elem, row)
+        osm_extra = ""
+        if timestamp:
+            osm_extra = ' xmlns:xapi="http://jxapi.openstreetmap.org/" xapi:timestamp="{}"'.format(timestamp)
 
-            write_tags_xml(elem, row)
+        yield '<osmChange version="0.6" generator="pyxapi" copyright="OpenStreetMap and contributors" attribution="http://www.openstreetmap.org/copyright" license="http://opendatacommons.org/licenses/odbl/1-0/"{}>\n'.format(osm_extra)
 
-            for nd in nds:
-                nd_elem = etree.Element('nd', ref=str(nd))
-                elem.append(nd_elem)
+        action = None
+        for row in stream_nodes(cursor):
+            (switch, action) = change_action_xml(action, row)
+            yield switch + write_node_xml(row)
 
-            yield etree.tostring(elem, encoding='utf8')
-            yield '\n'
+        for row in stream_ways(cursor, inline_geometry):
+            (switch, action) = change_action_xml(action, row)
+            yield switch + write_way_xml(row)
 
-        cursor.execute('''SELECT bbox_relations.id, version, user_id, tstamp, changeset_id, tags, name
-                        FROM bbox_relations, users where user_id = users.id ORDER BY id''')
+        for (row, members) in stream_relations(cursor):
+            (switch, action) = change_action_xml(action, row)
+            yield switch + write_relation_xml(row, members)
 
-        relation_cursor = g.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        for row in cursor:
-            relation_cursor.execute("""SELECT relation_id AS entity_id, member_id, member_type, member_role, sequence_id
-                                       FROM relation_members f
-                                       WHERE relation_id=%s
-                                       ORDER BY sequence_id""", (row.get('id'),))
+        if action is not None:
+            yield '</%s>\n' % action
 
-            elem = etree.Element('relation')
-            write_primitive_attributes_xml(elem, row)
+        yield '</osmChange>\n'
+    finally:
+        cursor.close()
 
-            write_tags_xml(elem, row)
+def pb_varint(value):
+    if value < 0:
+        # Negative int32/int64 values are encoded as 64 bit two's complement
+        value += 1 << 64
+
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+def pb_zigzag(value):
+    if value < 0:
+        return (-value << 1) - 1
+    return value << 1
+
+def pb_uint(field, value):
+    return pb_varint(field << 3) + pb_varint(value)
+
+def pb_bytes(field, data):
+    return pb_varint((field << 3) | 2) + pb_varint(len(data)) + data
+
+def pb_packed(field, values):
+    if not values:
+        return ''
+    return pb_bytes(field, ''.join([pb_varint(v) for v in values]))
+
+def pb_packed_sint(field, values):
+    return pb_packed(field, [pb_zigzag(v) for v in values])
+
+def pb_deltas(values):
+    deltas = []
+    last = 0
+    for value in values:
+        deltas.append(value - last)
+        last = value
+    return deltas
+
+class PBFStringTable(object):
+    """The string table of a PBF PrimitiveBlock. Index 0 is reserved."""
+
+    def __init__(self):
+        self.strings = ['']
+        self.index = {'': 0}
+
+    def __call__(self, string):
+        if isinstance(string, unicode):
+            string = string.encode('utf8')
+
+        sid = self.index.get(string)
+        if sid is None:
+            sid = len(self.strings)
+            self.index[string] = sid
+            self.strings.append(string)
+        return sid
+
+    def encode(self):
+        return ''.join([pb_bytes(1, string) for string in self.strings])
+
+def epoch_seconds(timestamp):
+    if isinstance(timestamp, basestring):
+        return calendar.timegm(time.strptime(timestamp.rstrip('Z'), '%Y-%m-%dT%H:%M:%S'))
+    return calendar.timegm(timestamp.utctimetuple())
+
+def pbf_nanodegrees(value):
+    return int(round(value * 1000000000))
+
+def pbf_coordinate(value):
+    # In units of the default granularity of 100 nanodegrees
+    return int(round(value * 10000000))
+
+def pbf_blob(blob_type, data):
+    """Frames a block as a zlib compressed blob, preceded by its BlobHeader."""
+    blob = pb_uint(2, len(data)) + pb_bytes(3, zlib.compress(data, pbf_compression_level))
+    header = pb_bytes(1, blob_type) + pb_uint(3, len(blob))
+    return struct.pack('!L', len(header)) + header + blob
+
+def pbf_header_block(bbox=None, timestamp=None, inline_geometry=False):
+    block = ''
+    if bbox:
+        (l, b, r, t) = bbox
+        block += pb_bytes(1, pb_uint(1, pb_zigzag(pbf_nanodegrees(l))) +
+                             pb_uint(2, pb_zigzag(pbf_nanodegrees(r))) +
+                             pb_uint(3, pb_zigzag(pbf_nanodegrees(t))) +
+                             pb_uint(4, pb_zigzag(pbf_nanodegrees(b))))
+
+    block += pb_bytes(4, 'OsmSchema-V0.6')
+    block += pb_bytes(4, 'DenseNodes')
+    if inline_geometry:
+        block += pb_bytes(5, 'LocationsOnWays')
+    block += pb_bytes(16, 'pyxapi')
+
+    if timestamp:
+        block += pb_uint(32, epoch_seconds(timestamp))
+
+    return block
+
+def pbf_info(strings, row):
+    return (pb_uint(1, row['version']) +
+            pb_uint(2, epoch_seconds(row['tstamp'])) +
+            pb_uint(3, row['changeset_id']) +
+            pb_uint(4, row['user_id']) +
+            pb_uint(5, strings(row['name'])))
+
+def pbf_tags(strings, row):
+    keys = []
+    vals = []
+    for (k, v) in (row['tags'] or {}).iteritems():
+        keys.append(strings(k))
+        vals.append(strings(v))
+    return pb_packed(2, keys) + pb_packed(3, vals)
+
+def pbf_primitive_block(strings, group):
+    return pb_bytes(1, strings.encode()) + pb_bytes(2, group)
+
+def pbf_nodes_block(rows):
+    strings = PBFStringTable()
+    ids = []
+    lats = []
+    lons = []
+    keys_vals = []
+    versions = []
+    timestamps = []
+    changesets = []
+    uids = []
+    user_sids = []
+
+    for row in rows:
+        ids.append(row['id'])
+        lats.append(pbf_coordinate(row['latitude']))
+        lons.append(pbf_coordinate(row['longitude']))
+
+        for (k, v) in (row['tags'] or {}).iteritems():
+            keys_vals.append(strings(k))
+            keys_vals.append(strings(v))
+        keys_vals.append(0)
+
+        versions.append(row['version'])
+        timestamps.append(epoch_seconds(row['tstamp']))
+        changesets.append(row['changeset_id'])
+        uids.append(row['user_id'])
+        user_sids.append(strings(row['name']))
+
+    dense_info = (pb_packed(1, versions) +
+                  pb_packed_sint(2, pb_deltas(timestamps)) +
+                  pb_packed_sint(3, pb_deltas(changesets)) +
+                  pb_packed_sint(4, pb_deltas(uids)) +
+                  pb_packed_sint(5, pb_deltas(user_sids)))
+
+    dense = (pb_packed_sint(1, pb_deltas(ids)) +
+             pb_bytes(5, dense_info) +
+             pb_packed_sint(8, pb_deltas(lats)) +
+             pb_packed_sint(9, pb_deltas(lons)) +
+             pb_packed(10, keys_vals))
+
+    return pbf_primitive_block(strings, pb_bytes(2, dense))
+
+def pbf_ways_block(rows):
+    strings = PBFStringTable()
+    group = []
+    for row in rows:
+        way = (pb_uint(1, row['id']) +
+               pbf_tags(strings, row) +
+               pb_bytes(4, pbf_info(strings, row)) +
+               pb_packed_sint(8, pb_deltas(row['nodes'] or [])))
+
+        coordinates = row.get('coordinates')
+        if coordinates is not None:
+            way += (pb_packed_sint(9, pb_deltas([pbf_coordinate(lat) for (lon, lat) in coordinates])) +
+                    pb_packed_sint(10, pb_deltas([pbf_coordinate(lon) for (lon, lat) in coordinates])))
+        group.append(pb_bytes(3, way))
+
+    return pbf_primitive_block(strings, ''.join(group))
+
+pbf_member_types = {'N': 0, 'W': 1, 'R': 2}
+
+def pbf_relations_block(rows):
+    strings = PBFStringTable()
+    group = []
+    for (row, members) in rows:
+        # The other formats pass unknown member types through as they are,
+        # but PBF can only encode these three
+        members = [member for member in members if member['member_type'] in pbf_member_types]
+
+        relation = (pb_uint(1, row['id']) +
+                    pbf_tags(strings, row) +
+                    pb_bytes(4, pbf_info(strings, row)) +
+                    pb_packed(8, [strings(member['member_role']) for member in members]) +
+                    pb_packed_sint(9, pb_deltas([member['member_id'] for member in members])) +
+                    pb_packed(10, [pbf_member_types[member['member_type']] for member in members]))
+        group.append(pb_bytes(4, relation))
+
+    return pbf_primitive_block(strings, ''.join(group))
+
+def stream_osm_data_as_pbf(cursor, bbox=None, timestamp=None, inline_geometry=False):
+    """Streams OSM data from psql temp tables as OSM PBF, a block at a time."""
 
-            for member in relation_cursor:
-                member_type = member.get('member_type', None)
-                if member_type == 'N':
-                    member_type = 'node'
-                elif member_type == 'W':
-                    member_type = 'way'
-                elif member_type == 'R':
-                    member_type = 'relation'
-                member['member_type'] = member_type
+    try:
+        yield pbf_blob('OSMHeader', pbf_header_block(bbox, timestamp, inline_geometry))
 
-                member_elem = etree.Element('member', {
-                    'role': unicode(member.get('member_role'), 'utf8'),
-                    'type': member.get('member_type'),
-                    'ref': str(member.get('member_id'))
-                })
-                elem.append(member_elem)
+        for rows in iter_batches(stream_nodes(cursor), pbf_block_size):
+            yield pbf_blob('OSMData', pbf_nodes_block(rows))
 
-            yield etree.tostring(elem, encoding='utf8')
-            yield '\n'
+        for rows in iter_batches(stream_ways(cursor, inline_geometry), pbf_block_size):
+            yield pbf_blob('OSMData', pbf_ways_block(rows))
 
-        yield '</osm>\n'
+        for rows in iter_batches(stream_relations(cursor), pbf_block_size):
+            yield pbf_blob('OSMData', pbf_relations_block(rows))
     finally:
         cursor.close()
 
-def query_nodes(cursor, where_str):
-    cursor.execute("""CREATE TEMPORARY TABLE bbox_nodes ON COMMIT DROP AS
-                        SELECT *
-                        FROM nodes
-                        WHERE %s""" % where_str)
+def cte_name(cursor, name, new=False):
+    """Returns the name of the latest CTE defined for a result set, or the
+    name the next definition will get if new is set."""
+    version = sum(1 for (set_name, _, _) in cursor.ctes if set_name == name)
+    if new:
+        version += 1
+    return '%s_%d' % (name, version)
+
+def cte_prefix(cursor):
+    """Builds the WITH clause that defines the bbox_* result sets for queries
+    against them. Empty when they're temp tables."""
+    if not cursor.ctes:
+        return ''
+
+    definitions = []
+    latest = collections.OrderedDict()
+    for (name, cte, sql) in cursor.ctes:
+        definitions.append('%s AS (%s)' % (cte, sql))
+        latest[name] = cte
+
+    for (name, cte) in latest.iteritems():
+        definitions.append('%s AS (SELECT * FROM %s)' % (name, cte))
+
+    return 'WITH RECURSIVE ' + ',\n'.join(definitions) + '\n'
+
+def result_set_name(cursor, name):
+    """Returns what to select from to read the current contents of a bbox_* result set."""
+    if query_engine == 'cte':
+        return cte_name(cursor, name)
+    return name
+
+def create_result_set(cursor, name, sql):
+    if query_engine == 'cte':
+        cursor.ctes.append((name, cte_name(cursor, name, new=True), sql))
+    else:
+        cursor.execute("""CREATE TEMPORARY TABLE %s ON COMMIT DROP AS %s""" % (name, sql))
+
+def add_primary_key(cursor, name):
+    if query_engine != 'cte':
+        cursor.execute("""ALTER TABLE ONLY %s ADD CONSTRAINT pk_%s PRIMARY KEY (id)""" % (name, name))
+
+@timed_phase('analyze_result_sets')
+def analyze_result_sets(cursor, *names):
+    if query_engine != 'cte':
+        for name in names:
+            cursor.execute("""ANALYZE %s""" % name)
+
+def has_rows(cursor, name):
+    cursor.execute(cte_prefix(cursor) + """SELECT EXISTS (SELECT 1 FROM %s)""" % name)
+    return cursor.fetchone()[0]
+
+def prepare(cursor, sql):
+    """Prepares sql (with %s placeholders) on the cursor's connection if it
+    hasn't been already, returning the statement's name."""
+    connection = cursor.connection
+    name = 'xapi_' + hashlib.sha1(sql).hexdigest()[:16]
+
+    if name not in connection.prepared:
+        if len(connection.prepared) >= prepared_statement_limit:
+            cursor.execute("""DEALLOCATE ALL""")
+            connection.prepared.clear()
+
+        placeholders = itertools.count(1)
+        cursor.execute("""PREPARE %s AS %s""" % (name, re.sub('%s', lambda m: '$%d' % next(placeholders), sql)))
+        connection.prepared[name] = sql
+
+    return name
+
+def execute_sql(sql, params):
+    """Builds the SQL to run a prepared statement with the given values."""
+    if not params:
+        return sql
+    return '%s(%s)' % (sql, ', '.join(['%s'] * len(params)))
+
+def select_result_set(cursor, name, table, where):
+    if isinstance(where, basestring):
+        where = Where(where)
+
+    sql = """SELECT * FROM %s WHERE %s""" % (table, where.sql)
+
+    if query_engine == 'cte' or not where.params:
+        create_result_set(cursor, name, where.mogrify(cursor, sql))
+    else:
+        statement = prepare(cursor, sql)
+        cursor.execute(execute_sql("""CREATE TEMPORARY TABLE %s ON COMMIT DROP AS EXECUTE %s""" % (name, statement), where.params), where.params)
+
+@timed_phase('query_nodes', rows=True)
+def query_nodes(cursor, where):
+    select_result_set(cursor, 'bbox_nodes', 'nodes', where)
 
-def query_ways(cursor, where_str):
-    cursor.execute("""CREATE TEMPORARY TABLE bbox_ways ON COMMIT DROP AS
-                        SELECT *
-                        FROM ways
-                        WHERE %s""" % where_str)
+@timed_phase('query_ways', rows=True)
+def query_ways(cursor, where):
+    select_result_set(cursor, 'bbox_ways', 'ways', where)
 
-def query_relations(cursor, where_str):
-    cursor.execute("""CREATE TEMPORARY TABLE bbox_relations ON COMMIT DROP AS
-                        SELECT *
-                        FROM relations
-                        WHERE %s""" % where_str)
+@timed_phase('query_relations', rows=True)
+def query_relations(cursor, where):
+    select_result_set(cursor, 'bbox_relations', 'relations', where)
 
+@timed_phase('backfill_way_nodes', rows=True)
 def backfill_way_nodes(cursor):
+    if query_engine == 'cte':
+        create_result_set(cursor, 'bbox_nodes', """SELECT * FROM %(nodes)s
+                UNION ALL
+                SELECT n.* FROM nodes n
+                WHERE n.id IN (SELECT unnest(nodes) FROM %(ways)s)
+                AND NOT EXISTS (
+                    SELECT * FROM %(nodes)s WHERE id = n.id
+                )""" % {
+                    'nodes': result_set_name(cursor, 'bbox_nodes'),
+                    'ways': result_set_name(cursor, 'bbox_ways')
+                })
+        return
+
     cursor.execute("""CREATE TEMPORARY TABLE bbox_way_nodes (id bigint) ON COMMIT DROP""")
     cursor.execute("""SELECT unnest_bbox_way_nodes()""")
     cursor.execute("""CREATE TEMPORARY TABLE bbox_missing_way_nodes ON COMMIT DROP AS
@@ -333,48 +1787,331 @@ def backfill_way_nodes(cursor):
     cursor.execute("""INSERT INTO bbox_nodes
                 SELECT n.* FROM nodes n INNER JOIN bbox_missing_way_nodes bwn ON n.id = bwn.id;""")
 
+@timed_phase('backfill_relations', rows=True)
 def backfill_relations(cursor):
-    cursor.execute("""CREATE TEMPORARY TABLE bbox_relations ON COMMIT DROP AS
-                     SELECT r.* FROM relations r
+    create_result_set(cursor, 'bbox_relations', """SELECT r.* FROM relations r
                      INNER JOIN (
                         SELECT relation_id FROM (
                             SELECT rm.relation_id AS relation_id FROM relation_members rm
-                            INNER JOIN bbox_nodes n ON rm.member_id = n.id WHERE rm.member_type = 'N'
+                            INNER JOIN %(nodes)s n ON rm.member_id = n.id WHERE rm.member_type = 'N'
                             UNION
                             SELECT rm.relation_id AS relation_id FROM relation_members rm
-                            INNER JOIN bbox_ways w ON rm.member_id = w.id WHERE rm.member_type = 'W'
+                            INNER JOIN %(ways)s w ON rm.member_id = w.id WHERE rm.member_type = 'W'
                          ) rids GROUP BY relation_id
-                    ) rids ON r.id = rids.relation_id""")
-
+                    ) rids ON r.id = rids.relation_id""" % {
+                        'nodes': result_set_name(cursor, 'bbox_nodes'),
+                        'ways': result_set_name(cursor, 'bbox_ways')
+                    })
+
+# The ids of relations in a result set plus all of their ancestors. UNION
+# (rather than UNION ALL) discards ids that have already been seen, which is
+# what stops the recursion on cyclic relation graphs.
+parent_relation_ids_sql = """SELECT id FROM %(relations)s
+                UNION
+                SELECT rm.relation_id FROM relation_members rm
+                INNER JOIN %(relation_ids)s p ON rm.member_id = p.id
+                WHERE rm.member_type = 'R'"""
+
+@timed_phase('backfill_parent_relations', rows=True)
 def backfill_parent_relations(cursor):
-    while True:
-        rows = cursor.execute("""INSERT INTO bbox_relations
-                    SELECT r.* FROM relations r INNER JOIN (
-                        SELECT rm.relation_id FROM relation_members rm
-                        INNER JOIN bbox_relations br ON rm.member_id = br.id
-                        WHERE rm.member_type = 'R' AND NOT EXISTS (
-                            SELECT * FROM bbox_relations br2 WHERE rm.relation_id = br2.id
-                        ) GROUP BY rm.relation_id
-                    ) rids ON r.id = rids.relation_id""")
-
-        if cursor.rowcount == 0:
-            break
+    """Adds every relation that is a parent (at any depth) of one in bbox_relations."""
+    if query_engine == 'cte':
+        relation_ids = cte_name(cursor, 'bbox_parent_relation_ids', new=True)
+        cursor.ctes.append(('bbox_parent_relation_ids', relation_ids, parent_relation_ids_sql % {
+            'relations': result_set_name(cursor, 'bbox_relations'),
+            'relation_ids': relation_ids
+        }))
+        create_result_set(cursor, 'bbox_relations', """SELECT r.* FROM relations r
+                WHERE r.id IN (SELECT id FROM %s)""" % relation_ids)
+        return
+
+    cursor.execute("""INSERT INTO bbox_relations
+                WITH RECURSIVE parent_relation_ids(id) AS (%s)
+                SELECT r.* FROM relations r
+                WHERE r.id IN (SELECT id FROM parent_relation_ids)
+                AND NOT EXISTS (
+                    SELECT * FROM bbox_relations br WHERE br.id = r.id
+                )""" % (parent_relation_ids_sql % {
+                    'relations': 'bbox_relations',
+                    'relation_ids': 'parent_relation_ids'
+                }))
+
+@timed_phase('keep_changed_since')
+def keep_changed_since(cursor, since):
+    """Drops everything in the bbox_* result sets that hasn't changed since since."""
+    for name in ('bbox_nodes', 'bbox_ways', 'bbox_relations'):
+        if query_engine == 'cte':
+            create_result_set(cursor, name, cursor.mogrify("""SELECT * FROM %s WHERE tstamp > %%s""" % result_set_name(cursor, name), (since,)))
+        else:
+            cursor.execute("""DELETE FROM %s WHERE tstamp <= %%s""" % name, (since,))
+
+def query_map(cursor, where, inline_geometry=False):
+    """Builds the bbox_* result sets for a map request. Ways' nodes outside
+    the bbox aren't needed when their geometry is sent inline."""
+    query_nodes(cursor, where)
+    add_primary_key(cursor, 'bbox_nodes')
+
+    query_ways(cursor, where.replace('geom', 'linestring'))
+    add_primary_key(cursor, 'bbox_ways')
+
+    backfill_relations(cursor)
+    backfill_parent_relations(cursor)
+    if not inline_geometry:
+        backfill_way_nodes(cursor)
+
+    analyze_result_sets(cursor, 'bbox_nodes', 'bbox_ways', 'bbox_relations')
+
+def split_bbox(bbox, grid):
+    """Splits a bbox into grid x grid tiles that share their edges exactly."""
+    (l, b, r, t) = bbox
+    xs = [l + (r - l) * i / grid for i in range(grid)] + [r]
+    ys = [b + (t - b) * i / grid for i in range(grid)] + [t]
+    return [(xs[i], ys[j], xs[i + 1], ys[j + 1]) for i in range(grid) for j in range(grid)]
+
+_tile_workers = None
+_tile_workers_pid = None
+_tile_workers_lock = threading.Lock()
+
+def get_tile_workers():
+    """Returns this process's pool of threads for querying map tiles."""
+    global _tile_workers, _tile_workers_pid
+
+    with _tile_workers_lock:
+        if _tile_workers_pid != os.getpid():
+            _tile_workers = multiprocessing.pool.ThreadPool(parallel_map_workers)
+            _tile_workers_pid = os.getpid()
+
+    return _tile_workers
+
+def query_map_tiles(cursor, bbox, inline_geometry=False):
+    """Queries a large bbox as tiles on several connections at once.
+
+    The request's own connection takes the first tile; the rest are checked
+    out of the pool (and returned by teardown_request) only if they are free
+    right away. Returns a TileCursors to stream from, or None if the bbox
+    wasn't split."""
+    if not parallel_map_enabled or bbox_area(bbox) < parallel_map_min_area:
+        return None
+
+    tiles = split_bbox(bbox, parallel_map_grid)
+    if len(tiles) < 2:
+        return None
+
+    pool = get_pool()
+    g.tile_connections = []
+    try:
+        for tile in tiles[1:]:
+            g.tile_connections.append(pool.getconn(timeout=0))
+    except PoolTimeout:
+        app.logger.info("Not splitting %s, only %s connections are free.", request.url, len(g.tile_connections) + 1)
+        for conn in g.tile_connections:
+            pool.putconn(conn)
+        g.tile_connections = []
+        return None
+
+    cursors = [cursor] + [conn.cursor(cursor_factory=XapiCursor) for conn in g.tile_connections]
+    for tile_cursor in cursors[1:]:
+        begin_snapshot(tile_cursor)
+    wheres = [parse_xapi('[bbox=%.7f,%.7f,%.7f,%.7f]' % tile) for tile in tiles]
+
+    start = time.time()
+    workers = get_tile_workers()
+    results = [workers.apply_async(query_map, (c, w, inline_geometry)) for (c, w) in zip(cursors, wheres)]
+
+    # Wait for every tile, even once one has failed: the connections can't be
+    # closed or returned to the pool while a worker is still using them
+    failure = None
+    for result in results:
+        try:
+            result.get()
+        except Exception:
+            if failure is None:
+                failure = sys.exc_info()
+
+    if failure is not None:
+        for tile_cursor in cursors[1:]:
+            tile_cursor.close()
+        raise failure[0], failure[1], failure[2]
+
+    record_phase('query_map_tiles', time.time() - start)
+
+    return TileCursors(cursors)
 
 class QueryError(Exception):
     pass
 
+class LRUCache(object):
+    """A small thread-safe LRU mapping holding at most max_size entries."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            value = self._entries.pop(key)
+            self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+plan_estimates = LRUCache(preflight_cache_size)
+
+def explain_query(cursor, table, where):
+    """Returns the planner's (rows, total cost) estimate for selecting from
+    table, reusing (and scaling by bbox area) one made for the same shape."""
+    (shape, area) = where.shape()
+    key = (table, shape)
+    estimate = plan_estimates.get(key)
+    if estimate is None:
+        cursor.execute(where.mogrify(cursor, """EXPLAIN (FORMAT JSON) SELECT * FROM %s WHERE %s""" % (table, where.sql)))
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, basestring):
+            plan = json.loads(plan)
+
+        plan = plan[0]['Plan']
+        estimate = (plan['Plan Rows'], plan['Total Cost'], area)
+        plan_estimates.put(key, estimate)
+
+    (rows, cost, estimated_area) = estimate
+    if area and estimated_area:
+        scale = area / estimated_area
+        return (rows * scale, cost * scale)
+    return (rows, cost)
+
+@timed_phase('preflight')
+def preflight(cursor, queries):
+    """Checks the planner's estimate for a search before running it.
+
+    queries is a list of (table, where) pairs. Returns a response to send
+    instead of running the search, or None if it should go ahead."""
+    if not preflight_enabled:
+        return None
+
+    rows = 0
+    cost = 0.0
+    for (table, where) in queries:
+        (table_rows, table_cost) = explain_query(cursor, table, where)
+        rows += table_rows
+        cost += table_cost
+
+    if cost > preflight_max_cost:
+        app.logger.info("Rejecting %s from %s because the planner estimates %s rows at cost %s.", request.url, request.access_route[0], rows, cost)
+        return Response('Query is too expensive (an estimated %d rows). Narrow it down with a smaller bbox or more specific tags.' % rows, status=413)
+
+    if cost > preflight_heavy_cost and g.admission == 'light':
+        # Give up our light slot and wait our turn for a heavy one
+        admission.release('light')
+        g.admission = None
+        try:
+            admission.acquire('heavy', request.access_route[0])
+        except Overloaded, e:
+            app.logger.info("Rejecting %s from %s (planner cost %s): %s", request.url, request.access_route[0], cost, e)
+            return Response("Server is overloaded right now. Try again later.", status=503, headers={'Retry-After': '30'})
+        g.admission = 'heavy'
+
+    return None
+
+class Where(object):
+    """A WHERE clause with %s placeholders for the values bound to it.
+
+    bboxes holds the (index of the first of its four values in params, bbox)
+    of each bbox in the clause, and page_index the index of a page's after_id,
+    so that shape() can leave them out."""
+
+    def __init__(self, sql, params=(), bboxes=(), page_index=None):
+        self.sql = sql
+        self.params = tuple(params)
+        self.bboxes = tuple(bboxes)
+        self.page_index = page_index
+
+    def replace(self, old, new):
+        return Where(self.sql.replace(old, new), self.params, self.bboxes, self.page_index)
+
+    def page(self, after_id, limit):
+        """Restricts this clause to one page of its matches, by id. The ORDER BY
+        and LIMIT ride along at the end of the clause, so it has to come last
+        in the statement."""
+        return Where('%s AND id > %%s ORDER BY id LIMIT %%s' % self.sql, self.params + (after_id, limit), self.bboxes, len(self.params))
+
+    def shape(self):
+        """Returns a key shared by clauses that differ only in where their bbox
+        is, its area to within a factor of two, and which page they're on,
+        along with the clause's bbox area (None without a bbox)."""
+        skipped = set()
+        area = None
+        for (index, bbox) in self.bboxes:
+            skipped.update(range(index, index + 4))
+            if area is None or bbox_area(bbox) < area:
+                area = bbox_area(bbox)
+        if self.page_index is not None:
+            skipped.add(self.page_index)
+
+        params = tuple(p for (i, p) in enumerate(self.params) if i not in skipped)
+
+        if area is None:
+            bucket = None
+        elif area > 0:
+            bucket = int(math.floor(math.log(area, 2)))
+        else:
+            bucket = 'empty'
+
+        return ((self.sql, params, bucket), area)
+
+    def mogrify(self, cursor, sql=None):
+        """Returns sql (by default, just this clause) with the values interpolated."""
+        if sql is None:
+            sql = self.sql
+        if not self.params:
+            return sql
+        return cursor.mogrify(sql, self.params)
+
+    def __eq__(self, other):
+        return isinstance(other, Where) and (self.sql, self.params) == (other.sql, other.params)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.sql, self.params))
+
+    def __repr__(self):
+        return 'Where(%r, %r)' % (self.sql, self.params)
+
+parsed_predicates = LRUCache(parse_cache_size)
+
 def parse_xapi(predicate):
+    """Parses an XAPI predicate into a Where."""
+    where = parsed_predicates.get(predicate)
+    if where is None:
+        where = _parse_xapi(predicate)
+        parsed_predicates.put(predicate, where)
+    return where
+
+def _parse_xapi(predicate):
     query = []
+    params = []
+    bboxes = []
     groups = re.findall(r'(?:\[(.*?)\])', predicate)
     for group in groups:
         (left, right) = group.split('=')
         if left == '@uid':
-            query.append(g.cursor.mogrify('uid = %s', [int(right)]))
+            query.append('uid = %s')
+            params.append(int(right))
         elif left == '@changeset':
-            query.append(g.cursor.mogrify('changeset_id = %s', [int(right)]))
+            query.append('changeset_id = %s')
+            params.append(int(right))
         elif left == 'bbox':
             try:
-                (l, b, r, t) = parse_bbox(right)
+                (l, b, r, t) = snap_bbox(parse_bbox(right))
             except ValueError, e:
                 raise QueryError('Invalid bbox.')
 
@@ -391,31 +2128,164 @@ def parse_xapi(predicate):
             if r < -180 or r > 180:
                 raise QueryError('Right is out of range.')
 
-            query.append(g.cursor.mogrify('ST_Intersects(geom, ST_GeometryFromText(\'POLYGON((%s %s, %s %s, %s %s, %s %s, %s %s))\', 4326))',
-                              [l, b,
-                               l, t,
-                               r, t,
-                               r, b,
-                               l, b]))
+            query.append('ST_Intersects(geom, ST_MakeEnvelope(%s, %s, %s, %s, 4326))')
+            bboxes.append((len(params), (l, b, r, t)))
+            params.extend([l, b, r, t])
         else:
             ors = []
             keys = left.split('|')
             vals = right.split('|')
             for (l,r) in itertools.product(keys, vals):
                 if r == '*':
-                    ors.append(g.cursor.mogrify('(tags ? %s)', [l]))
+                    ors.append('(tags ? %s::text)')
+                    params.append(l)
                 else:
-                    ors.append(g.cursor.mogrify('(tags @> hstore(%s, %s))', [l, r]))
+                    ors.append('(tags @> hstore(%s::text, %s::text))')
+                    params.extend([l, r])
             query.append('(' + ' OR '.join(ors) + ')')
-    query_str = ' AND '.join(query)
-    return query_str
+    return Where(' AND '.join(query), params, bboxes)
+
+id_separator = re.compile(r'[,\s]+')
+
+def parse_ids(ids_str):
+    return [int(i) for i in id_separator.split(ids_str.strip())]
+
+def request_id_list(name):
+    """Returns the id list for a lookup, from the query string or form, or
+    from the raw body of a POST if the list was too long for a URL."""
+    ids = request.values.get(name)
+    if ids is None and request.method == 'POST':
+        ids = request.data
+    return ids or ''
+
+def ids_where(cursor, ids):
+    """Builds a Where matching primitives with the given ids.
+
+    The ids are bound as a single array value, so every lookup shares one
+    prepared statement no matter how many ids it has. Very long lists are
+    copied into a temp table instead."""
+    ids = sorted(set(ids))
+
+    if len(ids) > bulk_id_copy_threshold:
+        cursor.execute("""CREATE TEMPORARY TABLE request_ids (id bigint PRIMARY KEY) ON COMMIT DROP""")
+        cursor.copy_from(StringIO('\n'.join(str(i) for i in ids)), 'request_ids', columns=('id',))
+        cursor.execute("""ANALYZE request_ids""")
+        return Where('id IN (SELECT id FROM request_ids)')
+
+    return Where('id = ANY(%s::bigint[])', ['{%s}' % ','.join(str(i) for i in ids)])
+
+class StalePage(Exception):
+    pass
+
+def page_query_hash(where):
+    return hashlib.sha1(repr((request.endpoint, where))).hexdigest()[:16]
+
+def request_page(where, tables):
+    """Reads the limit and continue parameters of a search that pages through
+    tables (in that order).
+
+    Returns None for an unpaged search, otherwise the (table, after_id,
+    limit) of the page to run. Raises QueryError for bad parameters and
+    StalePage for a token from before the latest replication."""
+    token = request.args.get('continue')
+    limit = request.args.get('limit')
+    if token is None and limit is None:
+        return None
+
+    page = (tables[0], 0, None)
+    if token is not None:
+        try:
+            state = json.loads(base64.urlsafe_b64decode(str(token)))
+            page = (state['table'], int(state['after']), int(state['limit']))
+            (timestamp, query) = (state['timestamp'], state['query'])
+        except (TypeError, ValueError, KeyError):
+            raise QueryError('Invalid continuation token.')
+
+        if query != page_query_hash(where) or page[0] not in tables:
+            raise QueryError('The continuation token is for a different search.')
+        if page_tokens_expire and timestamp != parse_timestamp(osmosis_work_dir):
+            raise StalePage('The data has been updated since this search began. Start it again without continue.')
+
+    if limit is not None:
+        try:
+            page = (page[0], page[1], int(limit))
+        except ValueError:
+            raise QueryError('Invalid limit.')
+
+    if page[2] < 1 or page[2] > search_max_page_size:
+        raise QueryError('The limit must be between 1 and %s.' % search_max_page_size)
+
+    return page
+
+def page_where(where, page, table):
+    """Returns the part of a (possibly paged) search that applies to table."""
+    if page is None:
+        return where
+    if page[0] != table:
+        return Where('FALSE')
+    return where.page(page[1], page[2])
+
+def next_page_token(cursor, where, tables, page):
+    """Builds the token for the page after the one just queried, or returns
+    None if it was the last."""
+    if page is None:
+        return None
+
+    (table, after_id, limit) = page
+    cursor.execute(cte_prefix(cursor) + """SELECT count(*), max(id) FROM bbox_%s""" % table)
+    (count, last_id) = cursor.fetchone()
+
+    if count >= limit:
+        after_id = last_id
+    elif tables.index(table) + 1 < len(tables):
+        (table, after_id) = (tables[tables.index(table) + 1], 0)
+    else:
+        return None
+
+    return base64.urlsafe_b64encode(json.dumps({
+        'table': table,
+        'after': after_id,
+        'limit': limit,
+        'timestamp': parse_timestamp(osmosis_work_dir),
+        'query': page_query_hash(where)
+    }))
+
+def add_next_page(response, token):
+    if token is not None:
+        args = request.args.copy()
+        args['continue'] = token
+        response.headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, url_encode(args))
+        response.headers['X-Continuation'] = token
+    return response
 
 def parse_bbox(bbox_str):
     return tuple(float(v) for v in bbox_str.split(','))
 
+def snap_bbox(bbox):
+    # OSM coordinates are stored to 7 decimal places, so any more precision
+    # than that only serves to make otherwise identical requests look different
+    return tuple(round(v, 7) for v in bbox)
+
+# Replication timestamps read from state.txt files, with the (mtime, size,
+# inode) they were read at
+_state_timestamps = {}
+
 def parse_timestamp(osmosis_work_dir):
+    """Returns the replication timestamp from osmosis's state.txt, only
+    rereading the file when it has changed."""
+    path = '{}/state.txt'.format(osmosis_work_dir)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    version = (st.st_mtime, st.st_size, st.st_ino)
+    cached = _state_timestamps.get(path)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
     try:
-        f = open('{}/state.txt'.format(osmosis_work_dir), 'r')
+        f = open(path, 'r')
     except:
         return None
 
@@ -426,8 +2296,80 @@ def parse_timestamp(osmosis_work_dir):
 
     f.close()
 
+    _state_timestamps[path] = (version, time_str)
     return time_str
 
+def parse_since(since_str):
+    """Parses a since= timestamp (as found in xapi:timestamp) into a datetime."""
+    return datetime.strptime(since_str.replace('\\', '').rstrip('Z'), '%Y-%m-%dT%H:%M:%S')
+
+def changes_predicate():
+    """Returns the XAPI predicate for a changes request, its predicate
+    parameter plus any bbox parameter."""
+    predicate = request.args.get('predicate', '')
+    if request.args.get('bbox'):
+        predicate += '[bbox=%s]' % request.args['bbox']
+    return predicate
+
+def request_validator_key():
+    """Normalizes the current request's query the same way its response is
+    built, or returns None if it doesn't get validators. Only needs the
+    request's parameters, not the database."""
+    if request.method not in ('GET', 'HEAD'):
+        return None
+
+    view_args = request.view_args or {}
+    try:
+        if request.endpoint == 'map':
+            query = parse_xapi('[bbox=%s]' % request.args['bbox'])
+        elif request.endpoint in ('nodes', 'ways', 'relations'):
+            query = tuple(sorted(set(parse_ids(view_args['ids']))))
+        elif request.endpoint in ('nodes_as_queryarg', 'ways_as_queryarg', 'relations_as_queryarg'):
+            query = tuple(sorted(set(parse_ids(request_id_list(request.endpoint.split('_')[0])))))
+        elif 'predicate' in view_args:
+            query = (parse_xapi(view_args['predicate']), request.args.get('limit'), request.args.get('continue'))
+        elif request.endpoint == 'changes':
+            query = (parse_xapi(changes_predicate()), parse_since(request.args['since']))
+        else:
+            return None
+    except (KeyError, ValueError, QueryError):
+        return None
+
+    output_format = request_format()
+    return (request.endpoint, query, output_format, request_encoding(output_format), request_inline_geometry())
+
+def request_validators():
+    """Returns the (ETag, Last-Modified) pair for the current request, or None.
+
+    Responses only change when replication moves the data forward, so the
+    validators are derived from the normalized request and the replication
+    timestamp."""
+    key = request_validator_key()
+    if key is None:
+        return None
+
+    timestamp = parse_timestamp(osmosis_work_dir)
+    if timestamp is None:
+        return None
+
+    etag = hashlib.sha1(repr(key + (timestamp,))).hexdigest()
+    return (etag, datetime.utcfromtimestamp(epoch_seconds(timestamp)))
+
+def is_not_modified(validators):
+    (etag, last_modified) = validators
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since is not None:
+        return last_modified <= request.if_modified_since
+    return False
+
+def add_validators(response, validators):
+    (etag, last_modified) = validators
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Vary'] = response_vary
+    return response
+
 @app.route("/api/capabilities")
 @app.route("/api/0.6/capabilities")
 def capabilities():
@@ -441,21 +2383,603 @@ def capabilities():
 <osm version="0.6" generator="pyxapi" copyright="OpenStreetMap and contributors" attribution="http://www.openstreetmap.org/copyright" license="http://opendatacommons.org/licenses/odbl/1-0/"{}>
   <api>
     <version minimum="0.6" maximum="0.6"/>
-    <area maximum="0.25"/>
+    <area maximum="{}"/>
     <timeout seconds="300"/>
   </api>
-</osm>""".format(timestamp)
+</osm>""".format(timestamp, max_bbox_area)
     return Response(xml, mimetype='application/xml')
 
-def request_wants_json():
-    best = request.accept_mimetypes.best_match(['application/xml', 'application/json'])
-    return best == 'application/json' and \
-           request.accept_mimetypes[best] >= request.accept_mimetypes['application/xml']
+# Responses depend on the Accept header (see request_format) as well as on
+# Accept-Encoding, so shared caches must key on both
+response_vary = 'Accept, Accept-Encoding'
+
+output_formats = {
+    'xml': ('application/xml', stream_osm_data_as_xml),
+    'json': ('application/json', stream_osm_data_as_json),
+    'pbf': ('application/x-protobuf', stream_osm_data_as_pbf),
+}
+
+# Changes are only available as osmChange XML
+change_formats = {
+    'xml': ('application/xml', stream_osm_change_as_xml),
+}
+
+# The formats endpoints offer, when it isn't all of output_formats
+endpoint_formats = {
+    'changes': change_formats,
+}
+
+def request_formats():
+    """Returns the formats on offer for the current request's endpoint,
+    mapped to their (mimetype, serializer)."""
+    return endpoint_formats.get(request.endpoint, output_formats)
+
+def request_inline_geometry():
+    """Whether ways should carry their node coordinates inline (geometry=inline)
+    instead of being accompanied by all of their nodes."""
+    return request.args.get('geometry') == 'inline'
+
+def request_format():
+    """Picks the output format from the format parameter or the Accept header,
+    out of those the endpoint offers, preferring XML (which all of them do).
+    Everything that depends on the format goes through here, so cache keys,
+    validators and the response itself always agree on it."""
+    formats = request_formats()
+    output_format = request.args.get('format')
+    if output_format in formats:
+        return output_format
+
+    mimetypes = [formats[f][0] for f in ('xml', 'json', 'pbf') if f in formats]
+    best = request.accept_mimetypes.best_match(mimetypes)
+    for (output_format, (mimetype, serializer)) in formats.iteritems():
+        if mimetype == best and request.accept_mimetypes[best] >= request.accept_mimetypes['application/xml']:
+            return output_format
+
+    return 'xml'
+
+def coalesce_chunks(iterable, chunk_size=None, flush_interval=None):
+    """Gathers the small strings yielded by a serializer into larger chunks.
+
+    The first string is passed straight through to keep time to first byte
+    low. After that, output is flushed once chunk_size bytes have built up or
+    flush_interval seconds have passed since the last flush. Both are only
+    checked when a new string arrives: nothing here runs while the serializer
+    is blocked, so a pending chunk can be held for as long as it stalls."""
+
+    if chunk_size is None:
+        chunk_size = stream_chunk_size
+    if flush_interval is None:
+        flush_interval = stream_flush_interval
+
+    try:
+        pending = []
+        pending_size = 0
+        last_flush = None
+
+        for piece in iterable:
+            pending.append(piece)
+            pending_size += len(piece)
+
+            now = time.time()
+            if last_flush is None or pending_size >= chunk_size or now - last_flush >= flush_interval:
+                yield ''.join(pending)
+                pending = []
+                pending_size = 0
+                last_flush = now
+
+        if pending:
+            yield ''.join(pending)
+    finally:
+        if hasattr(iterable, 'close'):
+            iterable.close()
+
+class ResponseCache(object):
+    """An LRU cache of complete response bodies.
+
+    Entries live in memory until memory_size bytes are in use, at which point
+    the least recently used are spilled to files in disk_dir (if set), which
+    is itself trimmed back to disk_size bytes. Keys end with the replication
+    timestamp the response was built from; seeing a newer one drops
+    everything cached so far, and responses built from an older one aren't
+    cached.
+
+    Each process spills to a subdirectory of disk_dir named after its pid. A
+    process (forked or not) starts with an empty cache, wiping its directory
+    and those of processes that are no longer running."""
+
+    def __init__(self, memory_size, disk_dir=None, disk_size=0):
+        self.memory_size = memory_size
+        self.disk_dir = disk_dir
+        self.disk_size = disk_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.timestamp = None
+        self._memory = collections.OrderedDict()
+        self._memory_used = 0
+        self._disk = collections.OrderedDict()
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self._pid = None
+
+        if disk_dir and not os.path.isdir(disk_dir):
+            os.makedirs(disk_dir)
+
+    def _process_dir(self):
+        return os.path.join(self.disk_dir, str(self._pid))
+
+    def _disk_path(self, key):
+        return os.path.join(self._process_dir(), hashlib.sha1(repr(key)).hexdigest() + '.cache')
+
+    def _check_process(self):
+        pid = os.getpid()
+        if pid == self._pid:
+            return
+
+        # Whatever was inherited over a fork belongs to the parent
+        self._pid = pid
+        self.timestamp = None
+        self._memory.clear()
+        self._memory_used = 0
+        self._disk.clear()
+        self._disk_used = 0
+
+        if not self.disk_dir:
+            return
+
+        for name in os.listdir(self.disk_dir):
+            path = os.path.join(self.disk_dir, name)
+            if name.isdigit() and os.path.isdir(path) and (int(name) == pid or not process_running(int(name))):
+                shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(self._process_dir())
+
+    def _check_timestamp(self, key):
+        """Drops everything cached if key is from a newer replication than
+        the cache has seen. Returns False if it's from an older one, which
+        requests that read the timestamp before a replication may still
+        finish with. (The ISO timestamps sort as text.)"""
+        timestamp = key[-1]
+        if self.timestamp is not None and timestamp < self.timestamp:
+            return False
+
+        if timestamp != self.timestamp:
+            self._clear()
+            self.timestamp = timestamp
+        return True
+
+    def _clear(self):
+        self._memory.clear()
+        self._memory_used = 0
+
+        for key in self._disk:
+            self._remove_file(key)
+        self._disk.clear()
+        self._disk_used = 0
+
+    def _remove_file(self, key):
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def _spill(self, key, entry):
+        if not self.disk_dir or key in self._disk:
+            return
+
+        (mimetype, body) = entry
+        f = tempfile.NamedTemporaryFile(dir=self._process_dir(), delete=False)
+        try:
+            f.write(mimetype + '\n')
+            f.write(body)
+        finally:
+            f.close()
+        os.rename(f.name, self._disk_path(key))
+
+        self._disk[key] = len(body)
+        self._disk_used += len(body)
+
+        while self._disk_used > self.disk_size and self._disk:
+            (old_key, size) = self._disk.popitem(last=False)
+            self._remove_file(old_key)
+            self._disk_used -= size
+            self.evictions += 1
+
+    def _store(self, key, entry):
+        if key in self._memory:
+            return
+
+        self._memory[key] = entry
+        self._memory_used += len(entry[1])
+
+        while self._memory_used > self.memory_size and self._memory:
+            (old_key, old_entry) = self._memory.popitem(last=False)
+            self._memory_used -= len(old_entry[1])
+            self._spill(old_key, old_entry)
+
+    def get(self, key):
+        """Returns the (mimetype, body) cached for key, or None."""
+        with self._lock:
+            self._check_process()
+            if not self._check_timestamp(key):
+                self.misses += 1
+                return None
+
+            entry = self._memory.pop(key, None)
+            if entry is not None:
+                self._memory[key] = entry
+                self.hits += 1
+                return entry
+
+            if key in self._disk:
+                try:
+                    f = open(self._disk_path(key), 'rb')
+                except IOError:
+                    self._disk_used -= self._disk.pop(key)
+                else:
+                    try:
+                        mimetype = f.readline().rstrip('\n')
+                        entry = (mimetype, f.read())
+                    finally:
+                        f.close()
+
+                    self._disk[key] = self._disk.pop(key)
+                    self._store(key, entry)
+                    self.hits += 1
+                    return entry
+
+            self.misses += 1
+            return None
+
+    def put(self, key, mimetype, body):
+        with self._lock:
+            self._check_process()
+            if self._check_timestamp(key):
+                self._store(key, (mimetype, body))
+
+def process_running(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno != errno.ESRCH
+    return True
+
+response_cache = None
+if response_cache_enabled:
+    response_cache = ResponseCache(response_cache_memory_size, response_cache_disk_dir, response_cache_disk_size)
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        if compression_sync_flush:
+            return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        if compression_sync_flush:
+            return self._compressor.compress(data) + self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        if compression_sync_flush:
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+# Content-Encodings we can produce, in order of preference
+compressors = collections.OrderedDict()
+if zstandard is not None:
+    compressors['zstd'] = ZstdCompressor
+if brotli is not None:
+    compressors['br'] = BrotliCompressor
+compressors['gzip'] = GzipCompressor
+
+def request_encoding(output_format):
+    """Picks the Content-Encoding to compress the response with, or None."""
+    if not compression_enabled or output_format == 'pbf':
+        # PBF blocks are already compressed
+        return None
+
+    encoding = request.accept_encodings.best_match(compressors.keys())
+    if encoding is None or request.accept_encodings[encoding] <= 0:
+        return None
+    return encoding
+
+def compress_stream(stream, encoding):
+    compressor = compressors[encoding](compression_level)
+    try:
+        for chunk in stream:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        stream.close()
+
+class Flight(object):
+    """A response being streamed by one request (the leader) that identical
+    requests arriving meanwhile (followers) are sent copies of.
+
+    The leader appends to a spill file as it streams and followers each read
+    it back at their own pace, so a slow follower never holds up the leader."""
+
+    def __init__(self, key):
+        self.key = key
+        self.mimetype = None
+        self.state = 'pending'
+        self.size = 0
+        self.followers = 0
+        self._spill = None
+        self._cond = threading.Condition()
+
+    def start(self, mimetype):
+        with self._cond:
+            self._spill = tempfile.NamedTemporaryFile(prefix='pyxapi-flight-')
+            self.mimetype = mimetype
+            self.state = 'streaming'
+            self._cond.notify_all()
+
+    def write(self, data):
+        self._spill.write(data)
+        self._spill.flush()
+
+        with self._cond:
+            self.size += len(data)
+            self._cond.notify_all()
+
+    def end(self, state, unless_followed=False):
+        """Finishes the flight as 'done' or 'failed'. Only the first call counts.
+
+        With unless_followed, the flight is left alone if anyone has started
+        following it. Returns whether the flight was ended."""
+        with self._cond:
+            if unless_followed and self.followers:
+                return False
+
+            if self.state not in ('done', 'failed'):
+                self.state = state
+                if self._spill is not None:
+                    # Followers that have already opened the spill file keep reading it
+                    self._spill.close()
+                self._cond.notify_all()
+
+        with flights_lock:
+            if flights.get(self.key) is self:
+                del flights[self.key]
+
+        return True
+
+    def follow(self, timeout):
+        """Waits for the leader to start streaming, then opens the spill file.
+        Returns None if the leader failed or took too long to start."""
+        deadline = time.time() + timeout
+        with self._cond:
+            while self.state == 'pending':
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+            if self.state != 'streaming':
+                return None
+
+            self.followers += 1
+            return io.open(self._spill.name, 'rb', buffering=0)
+
+    def read(self, spill):
+        """Streams the response from a spill file returned by follow."""
+        position = 0
+        try:
+            while True:
+                with self._cond:
+                    while position >= self.size and self.state == 'streaming':
+                        self._cond.wait()
+                    (size, state) = (self.size, self.state)
+
+                while position < size:
+                    data = spill.read(min(stream_chunk_size, size - position))
+                    position += len(data)
+                    yield data
+
+                if state == 'failed':
+                    raise IOError('The request being followed failed.')
+                if state == 'done':
+                    return
+        finally:
+            spill.close()
+
+flights = {}
+flights_lock = threading.Lock()
+
+def lead_flight(flight, mimetype, stream):
+    """Passes the leader's stream through, copying it to the flight's followers.
+
+    If the leader's client goes away, the rest of the stream is still written
+    out for any followers, who have given up their own connections by then."""
+    flight.start(mimetype)
+    completed = False
+    try:
+        for chunk in stream:
+            flight.write(chunk)
+            yield chunk
+        completed = True
+    except GeneratorExit:
+        if not flight.end('failed', unless_followed=True):
+            for chunk in stream:
+                flight.write(chunk)
+            completed = True
+        raise
+    finally:
+        flight.end('done' if completed else 'failed')
+        stream.close()
+
+def response_cache_key(where):
+    """Builds the cache key for the current request, or None if it shouldn't be
+    cached or coalesced.
+
+    Responses are cached as sent, so the key includes the Content-Encoding
+    and compressed responses are served again without recompressing them."""
+    if response_cache is None and not coalesce_enabled:
+        return None
+
+    timestamp = parse_timestamp(osmosis_work_dir)
+    if timestamp is None:
+        return None
+
+    output_format = request_format()
+    return (request.endpoint, where, output_format, request_encoding(output_format), request_inline_geometry(), timestamp)
+
+def cached_osm_response(cache_key):
+    """Returns a response from the cache if there is one for cache_key, or
+    one following an identical request that's already running.
+
+    Otherwise, this request becomes the leader that identical requests follow
+    until its osm_response has been streamed. Cached responses are sent, and
+    followers wait, after the request's connection and admission ticket are
+    given up; a follower whose leader fails takes them again (or gets the
+    503 returned here if it can't)."""
+    if cache_key is None:
+        return None
+
+    if response_cache is not None:
+        entry = response_cache.get(cache_key)
+        if entry is not None:
+            (mimetype, body) = entry
+            g.bytes_out = len(body)
+            g.rows_out = None
+            g.cursor.close()
+            release_database()
+            return encoded_response(Response(body, mimetype=mimetype), cache_key[3], 'HIT')
+
+    if not coalesce_enabled:
+        return None
+
+    with flights_lock:
+        flight = flights.get(cache_key)
+        if flight is None:
+            g.flight = flights[cache_key] = Flight(cache_key)
+            return None
+
+    # Don't hold a connection or admission slot while waiting on the leader
+    cost_class = g.admission
+    g.cursor.close()
+    release_database()
+
+    spill = flight.follow(coalesce_wait_timeout)
+    if spill is None:
+        # The query has to run here after all
+        return acquire_database(cost_class)
+
+    coalesced_requests.inc()
+    g.rows_out = None
+    stream = measure_stream(flight.read(spill))
+    return encoded_response(Response(stream_with_context(stream), mimetype=flight.mimetype), cache_key[3], 'COALESCED')
+
+def encoded_response(response, encoding, cache_status=None):
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = response_vary
+    if cache_status is not None:
+        response.headers['X-Cache'] = cache_status
+    return response
+
+def cache_stream(cache_key, mimetype, stream):
+    """Passes stream through, caching it if it completes and isn't too big."""
+    try:
+        parts = []
+        size = 0
+        for chunk in stream:
+            if parts is not None:
+                size += len(chunk)
+                if size > response_cache_max_entry_size:
+                    parts = None
+                else:
+                    parts.append(chunk)
+
+            yield chunk
+
+        if parts is not None:
+            response_cache.put(cache_key, mimetype, ''.join(parts))
+    finally:
+        stream.close()
+
+def osm_response(cursor, bbox=None, cache_key=None):
+    """Streams the contents of the bbox_* tables in the format the client asked
+    for, out of those the endpoint offers (see request_format)."""
+    timestamp = parse_timestamp(osmosis_work_dir)
+
+    output_format = request_format()
+    (mimetype, serializer) = request_formats()[output_format]
+    stream = coalesce_chunks(serializer(cursor, bbox=bbox, timestamp=timestamp, inline_geometry=request_inline_geometry()))
+
+    encoding = request_encoding(output_format)
+    if encoding is not None:
+        stream = compress_stream(stream, encoding)
+
+    if cache_key is not None and response_cache is not None:
+        stream = cache_stream(cache_key, mimetype, stream)
+
+    flight = getattr(g, 'flight', None)
+    if flight is not None:
+        stream = lead_flight(flight, mimetype, stream)
+
+    stream = measure_stream(stream)
+
+    cache_status = None
+    if cache_key is not None:
+        cache_status = 'MISS'
+
+    if spool_responses:
+        (spool, size) = spool_stream(stream)
+
+        # Everything has been read, so the database isn't needed any more
+        release_database()
+
+        response = Response(wrap_file(request.environ, spool), mimetype=mimetype, direct_passthrough=True)
+        response.content_length = size
+        return encoded_response(response, encoding, cache_status)
+
+    return encoded_response(Response(stream_with_context(stream), mimetype=mimetype), encoding, cache_status)
+
+def spool_stream(stream):
+    """Writes all of stream to a temp file, returning the file (rewound) and its size."""
+    spool = tempfile.TemporaryFile(dir=spool_dir)
+    try:
+        for chunk in stream:
+            spool.write(chunk)
+    except:
+        spool.close()
+        raise
+    finally:
+        stream.close()
+
+    size = spool.tell()
+    spool.seek(0)
+    return (spool, size)
 
 @app.route("/api/0.6/node/<string:ids>")
 def nodes(ids):
     try:
-        ids = [int(i) for i in ids.split(',')]
+        ids = parse_ids(ids)
     except ValueError, e:
         g.cursor.close()
         return Response(e.message, status=400)
@@ -465,9 +2989,9 @@ def nodes(ids):
         return Response('No IDs specified.', status=400)
 
     try:
-        query_nodes(g.cursor, g.cursor.mogrify('id IN %s', (tuple(ids),)))
+        query_nodes(g.cursor, ids_where(g.cursor, ids))
 
-        if g.cursor.rowcount < 1:
+        if not has_rows(g.cursor, 'bbox_nodes'):
             g.cursor.close()
             return Response('Node %s not found.' % ids, status=404)
 
@@ -480,20 +3004,17 @@ def nodes(ids):
         app.logger.exception(e)
         return Response(e.message, status=500)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return osm_response(g.cursor)
 
-@app.route('/api/0.6/nodes')
+@app.route('/api/0.6/nodes', methods=['GET', 'POST'])
 def nodes_as_queryarg():
-    ids = request.args.get('nodes', '')
+    ids = request_id_list('nodes')
     return nodes(ids)
 
 @app.route("/api/0.6/way/<string:ids>")
 def ways(ids):
     try:
-        ids = [int(i) for i in ids.split(',')]
+        ids = parse_ids(ids)
     except ValueError, e:
         g.cursor.close()
         return Response(e.message, status=400)
@@ -505,17 +3026,18 @@ def ways(ids):
     try:
         query_nodes(g.cursor, 'FALSE')
 
-        query_ways(g.cursor, g.cursor.mogrify('id IN %s', (tuple(ids),)))
+        query_ways(g.cursor, ids_where(g.cursor, ids))
 
-        if g.cursor.rowcount < 1:
+        if not has_rows(g.cursor, 'bbox_ways'):
             g.cursor.close()
             return Response('Way %s not found.' % ids, status=404)
 
-        g.cursor.execute("""ANALYZE bbox_ways""")
+        if not request_inline_geometry():
+            analyze_result_sets(g.cursor, 'bbox_ways')
 
-        backfill_way_nodes(g.cursor)
+            backfill_way_nodes(g.cursor)
 
-        g.cursor.execute("""ANALYZE bbox_nodes""")
+            analyze_result_sets(g.cursor, 'bbox_nodes')
 
         query_relations(g.cursor, 'FALSE')
     except Exception, e:
@@ -523,20 +3045,17 @@ def ways(ids):
         app.logger.exception(e)
         return Response(e.message, status=500)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return osm_response(g.cursor)
 
-@app.route('/api/0.6/ways')
+@app.route('/api/0.6/ways', methods=['GET', 'POST'])
 def ways_as_queryarg():
-    ids = request.args.get('ways', '')
+    ids = request_id_list('ways')
     return ways(ids)
 
 @app.route("/api/0.6/relation/<string:ids>")
 def relations(ids):
     try:
-        ids = [int(i) for i in ids.split(',')]
+        ids = parse_ids(ids)
     except ValueError, e:
         g.cursor.close()
         return Response(e.message, status=400)
@@ -550,9 +3069,9 @@ def relations(ids):
 
         query_ways(g.cursor, 'FALSE')
 
-        query_relations(g.cursor, g.cursor.mogrify('id IN %s', (tuple(ids),)))
+        query_relations(g.cursor, ids_where(g.cursor, ids))
 
-        if g.cursor.rowcount < 1:
+        if not has_rows(g.cursor, 'bbox_relations'):
             g.cursor.close()
             return Response('Relation %s not found.' % ids, status=404)
     except Exception, e:
@@ -560,14 +3079,11 @@ def relations(ids):
         app.logger.exception(e)
         return Response(e.message, status=500)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return osm_response(g.cursor)
 
-@app.route('/api/0.6/relations')
+@app.route('/api/0.6/relations', methods=['GET', 'POST'])
 def relations_as_queryarg():
-    ids = request.args.get('relations', '')
+    ids = request_id_list('relations')
     return relations(ids)
 
 @app.route('/api/0.6/map')
@@ -580,7 +3096,10 @@ def map():
         return Response('No bbox specified.', status=400)
 
     try:
-        query_str = parse_xapi('[bbox=%s]' % bbox)
+        where = parse_xapi('[bbox=%s]' % bbox)
+
+        if bbox_area(parse_bbox(bbox)) > max_bbox_area:
+            raise QueryError('The maximum bbox size is %s, and your request was too large.' % max_bbox_area)
     except QueryError, e:
         g.cursor.close()
         return Response(e.message, status=400)
@@ -588,109 +3107,159 @@ def map():
         g.cursor.close()
         return Response(e.message, status=400)
 
-    try:
-        query_nodes(g.cursor, query_str)
-        g.cursor.execute("""ALTER TABLE ONLY bbox_nodes ADD CONSTRAINT pk_bbox_nodes PRIMARY KEY (id)""")
-
-        query_ways(g.cursor, query_str.replace('geom', 'linestring'))
-        g.cursor.execute("""ALTER TABLE ONLY bbox_ways ADD CONSTRAINT pk_bbox_ways PRIMARY KEY (id)""")
-
-        backfill_relations(g.cursor)
-        backfill_parent_relations(g.cursor)
-        backfill_way_nodes(g.cursor)
+    cache_key = response_cache_key(where)
+    cached = cached_osm_response(cache_key)
+    if cached is not None:
+        g.cursor.close()
+        return cached
 
-        g.cursor.execute("""ANALYZE bbox_nodes""")
-        g.cursor.execute("""ANALYZE bbox_ways""")
-        g.cursor.execute("""ANALYZE bbox_relations""")
+    cursor = g.cursor
+    try:
+        tile_cursors = query_map_tiles(g.cursor, snap_bbox(parse_bbox(bbox)), request_inline_geometry())
+        if tile_cursors is not None:
+            cursor = tile_cursors
+        else:
+            query_map(g.cursor, where, request_inline_geometry())
     except Exception, e:
         g.cursor.close()
         app.logger.exception(e)
         return Response(e.message, status=500)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, bbox=parse_bbox(bbox), timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, bbox=parse_bbox(bbox), timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return osm_response(cursor, bbox=snap_bbox(parse_bbox(bbox)), cache_key=cache_key)
 
-@app.route('/api/0.6/node<string:predicate>')
-def search_nodes(predicate):
+def table_where(where, table):
+    """Returns where as it applies to table, whose geometry column may differ."""
+    if table == 'ways':
+        return where.replace('geom', 'linestring')
+    return where
+
+def search_response(predicate, tables, pipeline, cache_extra=None, paged=True, preflighted=True):
+    """Runs a search for an XAPI predicate and returns its response.
+
+    tables are the ones the search matches primitives in, in the order pages
+    go through them. pipeline(cursor, wheres) builds the bbox_* result sets,
+    given each table's part of the (possibly paged) search in wheres. Unpaged
+    responses are cached, keyed on cache_extra as well as the predicate."""
     try:
-        query_str = parse_xapi(predicate)
+        where = parse_xapi(predicate)
+        page = None
+        if paged:
+            page = request_page(where, tables)
     except QueryError, e:
         g.cursor.close()
         return Response(e.message, status=400)
     except ValueError, e:
         g.cursor.close()
         return Response(e.message, status=400)
+    except StalePage, e:
+        g.cursor.close()
+        return Response(e.message, status=410)
 
-    try:
-        query_nodes(g.cursor, query_str)
+    # Pages aren't cached, as the cache doesn't keep their continuation
+    cache_key = None
+    if page is None:
+        if cache_extra is None:
+            cache_key = response_cache_key(where)
+        else:
+            cache_key = response_cache_key((where, cache_extra))
+        cached = cached_osm_response(cache_key)
+        if cached is not None:
+            g.cursor.close()
+            return cached
 
-        query_ways(g.cursor, 'FALSE')
+    wheres = dict((table, page_where(table_where(where, table), page, table)) for table in tables)
 
-        query_relations(g.cursor, 'FALSE')
+    if preflighted:
+        try:
+            rejected = preflight(g.cursor, [(table, wheres[table]) for table in tables])
+        except Exception, e:
+            g.cursor.close()
+            app.logger.exception(e)
+            return Response(e.message, status=500)
+
+        if rejected is not None:
+            g.cursor.close()
+            return rejected
+
+    try:
+        pipeline(g.cursor, wheres)
+
+        token = next_page_token(g.cursor, where, tables, page)
     except Exception, e:
         g.cursor.close()
         app.logger.exception(e)
         return Response(e.message, status=500)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return add_next_page(osm_response(g.cursor, cache_key=cache_key), token)
+
+def query_primitives(cursor, wheres):
+    """The pipeline of a * search: nodes and ways, with the ways' nodes."""
+    query_nodes(cursor, wheres['nodes'])
+
+    query_ways(cursor, wheres['ways'])
+    if not request_inline_geometry():
+        backfill_way_nodes(cursor)
+
+    query_relations(cursor, 'FALSE')
+
+@app.route('/api/0.6/node<string:predicate>')
+def search_nodes(predicate):
+    def pipeline(cursor, wheres):
+        query_nodes(cursor, wheres['nodes'])
+        query_ways(cursor, 'FALSE')
+        query_relations(cursor, 'FALSE')
+
+    return search_response(predicate, ['nodes'], pipeline)
 
 @app.route('/api/0.6/way<string:predicate>')
 def search_ways(predicate):
-    try:
-        query_str = parse_xapi(predicate)
-    except QueryError, e:
-        g.cursor.close()
-        return Response(e.message, status=400)
-    except ValueError, e:
-        g.cursor.close()
-        return Response(e.message, status=400)
-
-    try:
-        query_nodes(g.cursor, 'FALSE')
+    def pipeline(cursor, wheres):
+        query_nodes(cursor, 'FALSE')
 
-        query_ways(g.cursor, query_str.replace('geom', 'linestring'))
-        backfill_way_nodes(g.cursor)
+        query_ways(cursor, wheres['ways'])
+        if not request_inline_geometry():
+            backfill_way_nodes(cursor)
 
-        query_relations(g.cursor, 'FALSE')
-    except Exception, e:
-        g.cursor.close()
-        app.logger.exception(e)
-        return Response(e.message, status=500)
+        query_relations(cursor, 'FALSE')
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return search_response(predicate, ['ways'], pipeline)
 
 @app.route('/api/0.6/relation<string:predicate>')
 def search_relations(predicate):
-    try:
-        query_str = parse_xapi(predicate)
-    except QueryError, e:
-        g.cursor.close()
-        return Response(e.message, status=400)
-    except ValueError, e:
-        g.cursor.close()
-        return Response(e.message, status=400)
+    def pipeline(cursor, wheres):
+        query_relations(cursor, wheres['relations'])
+        query_nodes(cursor, 'FALSE')
+        query_ways(cursor, 'FALSE')
 
-    query_relations(g.cursor, query_str)
-    query_nodes(g.cursor, 'FALSE')
-    query_ways(g.cursor, 'FALSE')
-
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return search_response(predicate, ['relations'], pipeline)
 
 @app.route('/api/0.6/*<string:predicate>')
 def search_primitives(predicate):
+    return search_response(predicate, ['nodes', 'ways'], query_primitives)
+
+@app.route('/api/0.6/changes')
+def changes():
+    """What changed since a timestamp in a bbox or matching a predicate, as an
+    osmChange.
+
+    A bbox alone gets the same primitives as a map call, anything else the
+    same as a * search. Only the ones edited after since are sent back. The
+    database only holds current versions, so deletions can't be reported."""
+    since = request.args.get('since')
+    if not since:
+        g.cursor.close()
+        return Response('No since timestamp specified.', status=400)
+
+    predicate = changes_predicate()
+    if not predicate:
+        g.cursor.close()
+        return Response('No bbox or predicate specified.', status=400)
+
     try:
-        query_str = parse_xapi(predicate)
+        since = parse_since(since)
+
+        if request.args.get('bbox') and bbox_area(parse_bbox(request.args['bbox'])) > max_bbox_area:
+            raise QueryError('The maximum bbox size is %s, and your request was too large.' % max_bbox_area)
     except QueryError, e:
         g.cursor.close()
         return Response(e.message, status=400)
@@ -698,22 +3267,32 @@ def search_primitives(predicate):
         g.cursor.close()
         return Response(e.message, status=400)
 
-    try:
-        query_nodes(g.cursor, query_str)
+    # A bbox alone is bounded by max_bbox_area, so isn't preflighted
+    map_request = not request.args.get('predicate')
 
-        query_ways(g.cursor, query_str.replace('geom', 'linestring'))
-        backfill_way_nodes(g.cursor)
+    def pipeline(cursor, wheres):
+        if map_request:
+            query_map(cursor, wheres['nodes'], request_inline_geometry())
+        else:
+            query_primitives(cursor, wheres)
 
-        query_relations(g.cursor, 'FALSE')
-    except Exception, e:
-        g.cursor.close()
-        app.logger.exception(e)
-        return Response(e.message, status=500)
+        keep_changed_since(cursor, since)
 
-    if request_wants_json():
-        return Response(stream_with_context(stream_osm_data_as_json(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/json')
-    else:
-        return Response(stream_with_context(stream_osm_data_as_xml(g.cursor, timestamp=parse_timestamp(osmosis_work_dir))), mimetype='application/xml')
+    return search_response(predicate, ['nodes', 'ways'], pipeline, cache_extra=since, paged=False, preflighted=not map_request)
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus metrics for this process."""
+    lines = []
+    for metric in (request_duration, phase_duration, response_bytes, response_rows, coalesced_requests):
+        lines.extend(metric.render())
+
+    if response_cache is not None:
+        for (name, value) in (('hits', response_cache.hits), ('misses', response_cache.misses), ('evictions', response_cache.evictions)):
+            lines.append('# TYPE xapi_response_cache_%s_total counter' % name)
+            lines.append('xapi_response_cache_%s_total %d' % (name, value))
+
+    return Response('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
 
 if __name__ == "__main__":
     app.run(debug=True, port=5000, processes=10)
\ No newline at end of file
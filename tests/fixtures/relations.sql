@@ -0,0 +1,57 @@
+-- Relation graphs for the parent relation closure (backfill_parent_relations).
+-- Only the columns the closure reads are created; tags are left out so the
+-- fixture loads without hstore.
+
+CREATE TABLE relations (
+    id bigint PRIMARY KEY,
+    version int NOT NULL DEFAULT 1,
+    user_id int NOT NULL DEFAULT 1,
+    tstamp timestamp without time zone NOT NULL DEFAULT '2012-01-01',
+    changeset_id bigint NOT NULL DEFAULT 1
+);
+
+CREATE TABLE relation_members (
+    relation_id bigint NOT NULL,
+    member_id bigint NOT NULL,
+    member_type character(1) NOT NULL,
+    member_role text NOT NULL DEFAULT '',
+    sequence_id int NOT NULL
+);
+
+-- Deep chain: 1 is a member of 2, 2 of 3, ... 500 of 501
+INSERT INTO relations (id) SELECT generate_series(1, 501);
+INSERT INTO relation_members (relation_id, member_id, member_type, sequence_id)
+    SELECT i + 1, i, 'R', 0 FROM generate_series(1, 500) i;
+
+-- Cycle: 1001 -> 1002 -> 1003 -> 1001, with 1003 also a member of 1004
+INSERT INTO relations (id) VALUES (1001), (1002), (1003), (1004);
+INSERT INTO relation_members (relation_id, member_id, member_type, sequence_id) VALUES
+    (1002, 1001, 'R', 0),
+    (1003, 1002, 'R', 0),
+    (1001, 1003, 'R', 0),
+    (1004, 1003, 'R', 0);
+
+-- A relation that is a member of itself, and of 2002
+INSERT INTO relations (id) VALUES (2001), (2002);
+INSERT INTO relation_members (relation_id, member_id, member_type, sequence_id) VALUES
+    (2001, 2001, 'R', 0),
+    (2002, 2001, 'R', 0);
+
+-- Diamond: 3001 is in 3002 and 3003, which are both in 3004. 3004 is in 3005,
+-- which forms a cycle with 3006
+INSERT INTO relations (id) VALUES (3001), (3002), (3003), (3004), (3005), (3006);
+INSERT INTO relation_members (relation_id, member_id, member_type, sequence_id) VALUES
+    (3002, 3001, 'R', 0),
+    (3003, 3001, 'R', 0),
+    (3004, 3002, 'R', 0),
+    (3004, 3003, 'R', 1),
+    (3005, 3004, 'R', 0),
+    (3006, 3005, 'R', 0),
+    (3005, 3006, 'R', 0);
+
+-- Members that share relation ids but aren't relations: 4001 has way 1 and
+-- node 1001, so it's no parent of relation 1 or 1001
+INSERT INTO relations (id) VALUES (4001);
+INSERT INTO relation_members (relation_id, member_id, member_type, sequence_id) VALUES
+    (4001, 1, 'W', 0),
+    (4001, 1001, 'N', 1);
@@ -0,0 +1,95 @@
+"""Checks the recursive parent relation closure against the loop it replaced.
+
+Needs a scratch PostgreSQL database, given as a libpq connection string in
+XAPI_TEST_DSN. Everything is created in a transaction that is rolled back."""
+
+import os
+import sys
+
+import psycopg2
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pyxapi'))
+import xapi
+
+fixture_path = os.path.join(os.path.dirname(__file__), 'fixtures', 'relations.sql')
+
+# backfill_parent_relations before the recursive query, with a bound on the
+# number of passes so a cycle it mishandled fails rather than hangs
+loop_max_passes = 1000
+loop_sql = """INSERT INTO bbox_relations
+            SELECT r.* FROM relations r INNER JOIN (
+                SELECT rm.relation_id FROM relation_members rm
+                INNER JOIN bbox_relations br ON rm.member_id = br.id
+                WHERE rm.member_type = 'R' AND NOT EXISTS (
+                    SELECT * FROM bbox_relations br2 WHERE rm.relation_id = br2.id
+                ) GROUP BY rm.relation_id
+            ) rids ON r.id = rids.relation_id"""
+
+start_sets = {
+    'chain': ([1], set(range(1, 502))),
+    'chain_middle': ([400], set(range(400, 502))),
+    'cycle': ([1001], set([1001, 1002, 1003, 1004])),
+    'self_member': ([2001], set([2001, 2002])),
+    'diamond_into_cycle': ([3001], set([3001, 3002, 3003, 3004, 3005, 3006])),
+    'mixed': ([1, 1002, 2002], set(range(1, 502)) | set([1001, 1002, 1003, 1004, 2002])),
+    'top': ([501, 4001], set([501, 4001])),
+}
+
+@pytest.fixture
+def cursor():
+    dsn = os.environ.get('XAPI_TEST_DSN')
+    if not dsn:
+        pytest.skip('XAPI_TEST_DSN is not set')
+
+    conn = psycopg2.connect(dsn, connection_factory=xapi.XapiConnection)
+    cursor = conn.cursor(cursor_factory=xapi.XapiCursor)
+    cursor.execute("""SET LOCAL statement_timeout TO '30s'""")
+    cursor.execute("""CREATE SCHEMA xapi_test""")
+    cursor.execute("""SET LOCAL search_path TO xapi_test""")
+    cursor.execute(open(fixture_path).read())
+
+    try:
+        yield cursor
+    finally:
+        conn.rollback()
+        conn.close()
+
+def loop_closure(cursor, ids):
+    cursor.execute("""CREATE TEMPORARY TABLE bbox_relations AS
+            SELECT * FROM relations WHERE id = ANY(%s)""", (ids,))
+
+    for i in range(loop_max_passes):
+        cursor.execute(loop_sql)
+        if cursor.rowcount == 0:
+            break
+    else:
+        pytest.fail('The loop was still adding relations after %d passes' % loop_max_passes)
+
+    cursor.execute("""SELECT id FROM bbox_relations""")
+    result = set(row[0] for row in cursor.fetchall())
+    cursor.execute("""DROP TABLE bbox_relations""")
+    return result
+
+def query_closure(cursor, ids, engine, monkeypatch):
+    monkeypatch.setattr(xapi, 'query_engine', engine)
+    cursor.ctes = []
+
+    xapi.create_result_set(cursor, 'bbox_relations', cursor.mogrify("""SELECT * FROM relations WHERE id = ANY(%s)""", (ids,)))
+    xapi.backfill_parent_relations(cursor)
+
+    cursor.execute(xapi.cte_prefix(cursor) + """SELECT id FROM %s""" % xapi.result_set_name(cursor, 'bbox_relations'))
+    result = [row[0] for row in cursor.fetchall()]
+    assert len(result) == len(set(result))
+
+    if engine == 'temp':
+        cursor.execute("""DROP TABLE bbox_relations""")
+    return set(result)
+
+@pytest.mark.parametrize('engine', ['temp', 'cte'])
+@pytest.mark.parametrize('name', sorted(start_sets))
+def test_closure_matches_loop(cursor, monkeypatch, engine, name):
+    (ids, expected) = start_sets[name]
+
+    assert loop_closure(cursor, ids) == expected
+    assert query_closure(cursor, ids, engine, monkeypatch) == expected